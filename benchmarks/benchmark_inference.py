@@ -0,0 +1,122 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+End-to-end inference benchmark of BiDAStereo on synthetic stereo videos.
+
+The model is built with random weights, so no checkpoint or dataset is needed.
+Every combination of resolution, kernel_size, iters and sequence length is run
+through forward_batch_test, reporting frames/sec, the per-stage latency from
+StageProfiler and the peak RSS. Results can be compared against a stored
+baseline:
+
+python ./benchmarks/benchmark_inference.py --baseline ./benchmarks/baseline_cpu.json
+"""
+
+import argparse
+import itertools
+import sys
+import time
+
+import torch
+
+from bidastereo.benchmarks.utils import (
+    build_model,
+    compare_with_baseline,
+    save_results,
+    synthetic_video,
+)
+from bidastereo.models.core.utils.profiler import (
+    StageProfiler,
+    read_peak_rss,
+    reset_peak_rss,
+)
+
+
+@torch.no_grad()
+def run_benchmark(model, video, kernel_size, iters, repeats, warmup):
+    for _ in range(warmup):
+        model.forward_batch_test({"stereo_video": video}, kernel_size=kernel_size, iters=iters)
+
+    model.profiler = StageProfiler(model.device)
+    reset_peak_rss()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.forward_batch_test({"stereo_video": video}, kernel_size=kernel_size, iters=iters)
+    elapsed = time.perf_counter() - start
+    summary = model.profiler.summary()
+    model.profiler = None
+
+    return {
+        "fps": repeats * len(video) / elapsed,
+        "sec_per_video": elapsed / repeats,
+        "stage_sec_per_video": {
+            name: stats["total_sec"] / repeats for name, stats in summary.items()
+        },
+        "peak_rss_mb": read_peak_rss() / 2 ** 20,
+    }
+
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    model = build_model(args.device)
+
+    results = {}
+    for resolution, kernel_size, iters, seq_len in itertools.product(
+        args.resolutions, args.kernel_sizes, args.iters, args.seq_lens
+    ):
+        height, width = map(int, resolution.split("x"))
+        name = f"{height}x{width}_k{kernel_size}_it{iters}_t{seq_len}"
+        video = synthetic_video(seq_len, height, width)
+        results[name] = run_benchmark(
+            model, video, kernel_size, iters, args.repeats, args.warmup
+        )
+        results[name].update(
+            height=height, width=width, kernel_size=kernel_size, iters=iters, seq_len=seq_len
+        )
+        print(name, f"{results[name]['fps']:.3f} fps")
+
+    save_results(args.output, results)
+    if args.baseline is not None:
+        regressions = compare_with_baseline(
+            results, args.baseline, "fps", higher_is_better=True, tolerance=args.tolerance
+        )
+        if args.fail_on_regression and len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inference benchmark of BiDAStereo on synthetic stereo videos."
+    )
+    parser.add_argument("--device", default="cpu", choices=["cuda", "cpu"])
+    parser.add_argument(
+        "--num_threads", type=int, default=0, help="CPU threads, 0 keeps the default."
+    )
+    parser.add_argument(
+        "--resolutions", nargs="+", default=["128x160", "256x320"], help="HxW."
+    )
+    parser.add_argument("--kernel_sizes", type=int, nargs="+", default=[6])
+    parser.add_argument("--iters", type=int, nargs="+", default=[4])
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[6, 10])
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=0)
+    parser.add_argument(
+        "--output", default="./outputs/benchmark_inference.json", help="result file."
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="result file of a previous run to compare to."
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="allowed relative fps drop."
+    )
+    parser.add_argument(
+        "--fail_on_regression",
+        action="store_true",
+        help="exit with an error if a benchmark is slower than the baseline.",
+    )
+    main(parser.parse_args())
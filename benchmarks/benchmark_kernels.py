@@ -0,0 +1,292 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Micro-benchmarks of the operators in the refinement loop of BiDAStereo.
+
+Every kernel is timed on the shapes of one pyramid level of a window and its
+output is checked against a plain reference implementation written
+independently of the model code, so that faster variants can be swapped in
+safely. The defaults correspond to a 20-frame window of 720x1280 video at the
+1/4 level:
+
+python ./benchmarks/benchmark_kernels.py --image_size 720 1280 --num_frames 20 --level 4
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+from tabulate import tabulate
+
+from bidastereo.benchmarks.utils import build_model, compare_with_baseline, save_results
+from bidastereo.models.core.corr import TFCL, TFCLVolume
+from bidastereo.models.core.update import MultiMotionEncoder, SKSepConvGRU3D
+
+
+def reference_tfcl(fmap1, fmap2, flow, small_patch):
+    """Correlation of fmap1 with the three groups of fmap2 sampled at x + flow."""
+    N, C, H, W = fmap1.shape
+    ys, xs = torch.meshgrid(
+        torch.arange(H, device=flow.device), torch.arange(W, device=flow.device), indexing="ij"
+    )
+    x = xs + flow[:, 0]
+    grid = torch.stack([2 * x / (W - 1) - 1, (2 * ys / (H - 1) - 1).expand_as(x)], dim=-1)
+    right = F.grid_sample(fmap2, grid.repeat(3, 1, 1, 1), align_corners=True)
+
+    pady, padx = (1, 1) if small_patch else (0, 4)
+    corrs = []
+    for group in range(3):
+        right_pad = F.pad(right[group * N : (group + 1) * N], [padx, padx, pady, pady], mode="replicate")
+        for dy in range(2 * pady + 1):
+            for dx in range(2 * padx + 1):
+                crop = right_pad[:, :, dy : dy + H, dx : dx + W]
+                corrs.append((fmap1 * crop).sum(dim=1, keepdim=True) / C)
+    return torch.cat(corrs, dim=1)
+
+
+def reference_sksepconvgru3d(gru, h, x):
+    """SKSepConvGRU3D with the spatial convolutions applied frame by frame in 2D."""
+    b, _, t, height, width = h.shape
+
+    def per_frame(conv, y):
+        y = rearrange(y, "b c t h w -> (b t) c h w")
+        y = F.conv2d(y, conv.weight[:, :, 0], conv.bias, padding=conv.padding[1:])
+        return rearrange(y, "(b t) c h w -> b c t h w", b=b)
+
+    def horizontal(conv, y):
+        if isinstance(conv, torch.nn.Sequential):
+            return per_frame(conv[2], F.gelu(per_frame(conv[0], y)))
+        return per_frame(conv, y)
+
+    def temporal(conv, y):
+        return F.conv3d(y, conv.weight, conv.bias, padding=conv.padding)
+
+    gates = [
+        (horizontal, gru.convz1, gru.convr1, gru.convq1),
+        (per_frame, gru.convz2, gru.convr2, gru.convq2),
+        (temporal, gru.convz3, gru.convr3, gru.convq3),
+    ]
+    for apply, convz, convr, convq in gates:
+        hx = torch.cat([h, x], dim=1)
+        z = torch.sigmoid(apply(convz, hx))
+        r = torch.sigmoid(apply(convr, hx))
+        q = torch.tanh(apply(convq, torch.cat([r * h, x], dim=1)))
+        h = (1 - z) * h + z * q
+    return h
+
+
+def reference_warp(x, flow):
+    N, _, H, W = x.shape
+    ys, xs = torch.meshgrid(
+        torch.arange(H, device=x.device), torch.arange(W, device=x.device), indexing="ij"
+    )
+    gx = 2 * (xs + flow[:, 0]) / (W - 1) - 1
+    gy = 2 * (ys + flow[:, 1]) / (H - 1) - 1
+    return F.grid_sample(x, torch.stack([gx, gy], dim=-1), align_corners=True)
+
+
+def reference_motion_encoder(encoder, motion_hidden_state, flow_forward, flow_backward, flow, corr, t):
+    """MultiMotionEncoder with the hidden states warped frame by frame."""
+    BN, _, H, W = flow.shape
+    hidden = motion_hidden_state.view(BN, -1, H, W)
+    backward = [reference_warp(hidden[i + 1 : i + 2], flow_backward[i : i + 1]) for i in range(t - 1)]
+    forward = [reference_warp(hidden[i : i + 1], flow_forward[i : i + 1]) for i in range(t - 1)]
+    backward = torch.cat(backward + [hidden[-1:]])
+    forward = torch.cat([hidden[:1]] + forward)
+
+    cor = torch.cat([encoder.convc1(c) for c in corr.chunk(3, dim=1)], dim=1)
+    cor = F.relu(encoder.convc2(F.gelu(cor)))
+    flo = F.relu(encoder.convf2(F.relu(encoder.convf1(flow))))
+    out = F.relu(encoder.conv(torch.cat([cor, flo, forward, backward, hidden], dim=1)))
+    return torch.cat([out[:, :126], flow], dim=1), out[:, 126:]
+
+
+def reference_convex_upsample(flow, mask, rate):
+    N, _, H, W = flow.shape
+    mask = torch.softmax(mask.view(N, 9, rate, rate, H, W), dim=1)
+    neighbours = F.unfold(rate * flow, [3, 3], padding=1).view(N, 2, 9, H, W)
+    up_flow = torch.einsum("nkijhw,nckhw->nchiwj", mask, neighbours)
+    return up_flow.reshape(N, 2, rate * H, rate * W)
+
+
+def get_kernels(args, device):
+    """Returns {name: (reference, {candidate: function})} of argument-free functions."""
+    torch.manual_seed(0)
+    T = args.num_frames
+    H, W = args.image_size[0] // args.level, args.image_size[1] // args.level
+    max_flow = args.max_disparity / args.level
+
+    fmap1 = torch.randn(T, 256, H, W, device=device)
+    fmap2 = torch.randn(3 * T, 256, H, W, device=device)
+    flow = torch.zeros(T, 2, H, W, device=device)
+    flow[:, 0] = -max_flow * torch.rand(T, H, W, device=device)
+    flow_forward = max_flow / 4 * torch.randn(T - 1, 2, H, W, device=device)
+    flow_backward = max_flow / 4 * torch.randn(T - 1, 2, H, W, device=device)
+
+    kernels = {}
+    tfcl = TFCL(fmap1, fmap2)
+    # the volumes are built once per level, only the lookups are timed
+    volume = None
+    if TFCLVolume.volume_numel(fmap1) <= args.max_volume_elements:
+        volume = TFCLVolume(fmap1, fmap2)
+    for small_patch in (False, True):
+        candidates = {"TFCL": lambda sp=small_patch: tfcl(flow, None, small_patch=sp)}
+        if volume is not None:
+            candidates["TFCLVolume"] = lambda sp=small_patch: volume(flow, None, small_patch=sp)
+        name = "tfcl_small_patch" if small_patch else "tfcl"
+        kernels[name] = (
+            lambda sp=small_patch: reference_tfcl(fmap1, fmap2, flow, sp),
+            candidates,
+        )
+
+    gru = SKSepConvGRU3D(hidden_dim=128, input_dim=256).to(device).eval()
+    h = torch.tanh(torch.randn(1, 128, T, H, W, device=device))
+    x = torch.randn(1, 256, T, H, W, device=device)
+    kernels["sksepconvgru3d"] = (
+        lambda: reference_sksepconvgru3d(gru, h, x),
+        {"SKSepConvGRU3D": lambda: gru(h, x)},
+    )
+
+    encoder = MultiMotionEncoder(cor_planes=27).to(device).eval()
+    motion_hidden_state = torch.randn(T, 48, H, W, device=device)
+    corr = torch.randn(T, 27, H, W, device=device)
+    kernels["multi_motion_encoder"] = (
+        lambda: reference_motion_encoder(
+            encoder, motion_hidden_state, flow_forward, flow_backward, flow, corr, T
+        ),
+        {
+            "MultiMotionEncoder": lambda: encoder(
+                motion_hidden_state, flow_forward, flow_backward, flow, corr, t=T
+            )
+        },
+    )
+
+    model = build_model(device)
+    mask = torch.randn(T, 9 * 16, H, W, device=device)
+    kernels["convex_upsample"] = (
+        lambda: reference_convex_upsample(flow, mask, 4),
+        {"BiDAStereo.convex_upsample": lambda: model.convex_upsample(flow, mask, rate=4)},
+    )
+    return kernels
+
+
+def max_abs_error(output, reference):
+    if isinstance(output, (tuple, list)):
+        return max(max_abs_error(o, r) for o, r in zip(output, reference))
+    return (output.float() - reference.float()).abs().max().item()
+
+
+def time_function(function, device, repeats, warmup):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        function()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+@torch.no_grad()
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+
+    # results of different shapes are kept apart when compared to a baseline
+    shape = f"t{args.num_frames}_{args.image_size[0]}x{args.image_size[1]}_l{args.level}"
+    results = {}
+    for kernel, (reference, candidates) in get_kernels(args, device).items():
+        if args.kernels is not None and kernel not in args.kernels:
+            continue
+        expected = reference()
+        for candidate, function in candidates.items():
+            error = max_abs_error(function(), expected)
+            times = time_function(function, device, args.repeats, args.warmup)
+            results[f"{shape}/{kernel}/{candidate}"] = {
+                "median_sec": statistics.median(times),
+                "min_sec": min(times),
+                "max_abs_error": error,
+                "passed": error <= args.atol,
+            }
+
+    print(
+        tabulate(
+            [
+                [name, r["median_sec"], r["max_abs_error"], r["passed"]]
+                for name, r in results.items()
+            ],
+            headers=["kernel", "median_sec", "max_abs_error", "passed"],
+        )
+    )
+    save_results(args.output, results)
+
+    failed = not all(r["passed"] for r in results.values())
+    if args.baseline is not None:
+        regressions = compare_with_baseline(
+            results, args.baseline, "median_sec", higher_is_better=False, tolerance=args.tolerance
+        )
+        failed = failed or (args.fail_on_regression and len(regressions) > 0)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the refinement operators of BiDAStereo."
+    )
+    parser.add_argument("--device", default="cpu", choices=["cuda", "cpu"])
+    parser.add_argument(
+        "--num_threads", type=int, default=0, help="CPU threads, 0 keeps the default."
+    )
+    parser.add_argument(
+        "--kernels", nargs="+", default=None, help="run only these kernels."
+    )
+    parser.add_argument(
+        "--image_size", type=int, nargs=2, default=[720, 1280], help="video resolution."
+    )
+    parser.add_argument("--num_frames", type=int, default=20, help="frames per window.")
+    parser.add_argument(
+        "--level", type=int, default=4, choices=[4, 8, 16], help="pyramid level."
+    )
+    parser.add_argument(
+        "--max_disparity", type=float, default=192, help="largest disparity in pixels."
+    )
+    parser.add_argument(
+        "--max_volume_elements",
+        type=int,
+        default=2 ** 28,
+        help="TFCLVolume is benchmarked when its volumes fit into this budget.",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--atol", type=float, default=1e-4, help="allowed error against the references."
+    )
+    parser.add_argument(
+        "--output", default="./outputs/benchmark_kernels.json", help="result file."
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="result file of a previous run to compare to."
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="allowed relative slowdown."
+    )
+    parser.add_argument(
+        "--fail_on_regression",
+        action="store_true",
+        help="exit with an error if a kernel is slower than the baseline.",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,107 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import platform
+import subprocess
+
+import torch
+import torch.nn.functional as F
+from tabulate import tabulate
+
+from bidastereo.models.core.bidastereo import BiDAStereo
+
+
+def build_model(device="cpu", **kwargs):
+    """BiDAStereo with random weights, RAFT included."""
+    torch.manual_seed(0)
+    model = BiDAStereo(device=device, raft_weights="", **kwargs)
+    return model.to(device).eval()
+
+
+def synthetic_video(num_frames, height, width, max_disparity=32, seed=0):
+    """
+    Stereo video [T, 2, 3, H, W] in [0, 255] of a smooth random texture panning
+    by one pixel per frame, the right view is shifted by a disparity that
+    grows from top to bottom up to `max_disparity`.
+    """
+    g = torch.Generator().manual_seed(seed)
+    full_width = width + max_disparity + num_frames
+    texture = torch.rand(1, 3, height // 8, full_width // 8, generator=g)
+    texture = F.interpolate(
+        texture, size=(height, full_width), mode="bilinear", align_corners=True
+    )[0]
+
+    disparity = torch.linspace(0, max_disparity, height)[:, None].expand(height, width)
+    xs = torch.arange(width, dtype=torch.float)[None].expand(height, width)
+    frames = []
+    for t in range(num_frames):
+        x_left = xs + max_disparity + t
+        left = sample_columns(texture, x_left)
+        right = sample_columns(texture, x_left - disparity)
+        frames.append(torch.stack([left, right]))
+    return torch.stack(frames) * 255
+
+
+def sample_columns(texture, x):
+    """Sample texture [C, H, W] at the column coordinates x [H, W]."""
+    _, h, w = texture.shape
+    ys = torch.linspace(-1, 1, h)[:, None].expand_as(x)
+    grid = torch.stack([2 * x / (w - 1) - 1, ys], dim=-1)[None]
+    return F.grid_sample(texture[None], grid, align_corners=True)[0]
+
+
+def environment_info():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"environment": environment_info(), "results": results}, f, indent=4)
+    print(f"Dumping benchmark results to {path}.")
+
+
+def compare_with_baseline(results, baseline_path, metric, higher_is_better, tolerance):
+    """
+    Print `metric` of every benchmark next to the stored baseline and return
+    the names of the benchmarks that got worse by more than `tolerance`.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    rows, regressions = [], []
+    for name, result in results.items():
+        if name not in baseline:
+            rows.append([name, result[metric], None, None])
+            continue
+        change = result[metric] / baseline[name][metric] - 1
+        worse = -change if higher_is_better else change
+        if worse > tolerance:
+            regressions.append(name)
+        rows.append([name, result[metric], baseline[name][metric], f"{100 * change:+.1f}%"])
+
+    print(tabulate(rows, headers=["benchmark", metric, "baseline", "change"]))
+    if len(regressions) > 0:
+        print(f"Regressions beyond {100 * tolerance:.0f}%: {', '.join(regressions)}")
+    return regressions
@@ -114,7 +114,25 @@ class SequenceDispFlowAugmentor:
 
         return seq
 
-    def spatial_transform(self, img, disp):
+    def crop_flow(self, flow, x0, y0):
+        """
+        Crop a 1/4 resolution flow [h, w, 2] as its image is cropped at (x0, y0)
+        to crop_size. Offsets that are not multiples of 4 fall between the
+        pixels of the flow, which is then resampled.
+        """
+        ch, cw = self.crop_size[0] // 4, self.crop_size[1] // 4
+        if x0 % 4 == 0 and y0 % 4 == 0:
+            return flow[y0 // 4 : y0 // 4 + ch, x0 // 4 : x0 // 4 + cw]
+        shift = np.float32([[1, 0, x0 / 4], [0, 1, y0 / 4]])
+        return cv2.warpAffine(
+            flow,
+            shift,
+            (cw, ch),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_REPLICATE,
+        )
+
+    def spatial_transform(self, img, disp, flow=None):
         # randomly sample scale
         ht, wd = img[0][0].shape[:2]
         min_scale = np.maximum(
@@ -151,13 +169,26 @@ class SequenceDispFlowAugmentor:
                             interpolation=cv2.INTER_LINEAR,
                         )
                         disp[i][cam] = disp[i][cam] * [scale_x, scale_y]
+            if flow is not None:
+                # the 1/4 resolution flows of the right view stay on the 1/4 grid
+                # of the rescaled images
+                size = (img[0][1].shape[1] // 4, img[0][1].shape[0] // 4)
+                for i in range(len(flow)):
+                    for direction in (0, 1):
+                        flow[i][direction] = cv2.resize(
+                            flow[i][direction], size, interpolation=cv2.INTER_LINEAR
+                        )
+                        flow[i][direction] = flow[i][direction] * [scale_x, scale_y]
 
+        # crop offsets of the right view, used to crop its flows
+        y_right = []
         if self.yjitter:
             y0 = np.random.randint(2, img[0][0].shape[0] - self.crop_size[0] - 2)
             x0 = np.random.randint(2, img[0][0].shape[1] - self.crop_size[1] - 2)
 
             for i in range(len(img)):
                 y1 = y0 + np.random.randint(-2, 2 + 1)
+                y_right.append(y1)
                 img[i][0] = img[i][0][
                     y0 : y0 + self.crop_size[0], x0 : x0 + self.crop_size[1]
                 ]
@@ -183,18 +214,30 @@ class SequenceDispFlowAugmentor:
                         disp[i][cam] = disp[i][cam][
                             y0 : y0 + self.crop_size[0], x0 : x0 + self.crop_size[1]
                         ]
+            y_right = [y0] * len(img)
+
+        if flow is not None:
+            for i in range(len(flow)):
+                # backward flows go from frame i to i + 1, forward flows from
+                # frame i + 1 to i, each is cropped with its source frame and
+                # corrected for the vertical jitter between the two crops
+                for direction, (src, dst) in enumerate([(i + 1, i), (i, i + 1)]):
+                    f = self.crop_flow(flow[i][direction], x0, y_right[src])
+                    flow[i][direction] = f + [0, (y_right[src] - y_right[dst]) / 4]
 
-        return img, disp
+        return img, disp, flow
 
-    def __call__(self, img, disp):
+    def __call__(self, img, disp, flow=None):
         img = self.color_transform(img)
         img = self.eraser_transform(img)
-        img, disp = self.spatial_transform(img, disp)
+        img, disp, flow = self.spatial_transform(img, disp, flow)
 
         for i in range(len(img)):
             for cam in (0, 1):
                 img[i][cam] = np.ascontiguousarray(img[i][cam])
                 if len(disp[i]) > 0:
                     disp[i][cam] = np.ascontiguousarray(disp[i][cam])
+                if flow is not None and i < len(flow):
+                    flow[i][cam] = np.ascontiguousarray(flow[i][cam], dtype=np.float32)
 
-        return img, disp
+        return img, disp, flow
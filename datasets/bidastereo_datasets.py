@@ -15,6 +15,7 @@ import numpy as np
 import torch.utils.data as data
 import torch.nn.functional as F
 import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 from collections import defaultdict
@@ -24,10 +25,13 @@ from typing import List, Optional
 from pytorch3d.renderer.cameras import PerspectiveCameras
 from pytorch3d.implicitron.dataset.types import (
     FrameAnnotation as ImplicitronFrameAnnotation,
+    ViewpointAnnotation,
     load_dataclass,
 )
 
 from bidastereo.datasets import frame_utils
+from bidastereo.datasets.sample_index import SequenceWindows
+from bidastereo.datasets.shards import ShardReader
 from bidastereo.evaluation.utils.eval_utils import depth2disparity_scale
 from bidastereo.datasets.augmentor import SequenceDispFlowAugmentor
 
@@ -39,9 +43,56 @@ class DynamicReplicaFrameAnnotation(ImplicitronFrameAnnotation):
     camera_name: Optional[str] = None
 
 
+# bumped whenever the cached annotation index changes its layout
+ANNOTATION_INDEX_VERSION = 1
+
+
+def get_flow_path(flow_root, root, image1, image2):
+    """
+    Path of the precomputed RAFT flows between two frames of the right view,
+    laid out under flow_root as the images are under the dataset root.
+    """
+    name = osp.splitext(osp.relpath(image1, root))[0]
+    return osp.join(flow_root, f"{name}_{osp.splitext(osp.basename(image2))[0]}.npz")
+
+
+def get_decode_threads(decode_threads, num_workers):
+    """
+    Size of the decode thread pool of each DataLoader worker, -1 splits the
+    CPU cores between the workers (or gives all of them to the main process).
+    """
+    if decode_threads >= 0:
+        return decode_threads
+    return max(1, (os.cpu_count() or 1) // max(1, num_workers))
+
+
+def read_image(path):
+    img = np.array(frame_utils.read_gen(path)).astype(np.uint8)
+    # grayscale images
+    if len(img.shape) == 2:
+        return np.tile(img[..., None], (1, 1, 3))
+    return img[..., :3]
+
+
+def read_mask(path):
+    return np.array(frame_utils.read_gen(path)) / 255.0
+
+
+def read_flows(path):
+    """Forward and backward flows written by scripts/precompute_flows.py."""
+    with np.load(path) as flows:
+        return [
+            flows[direction].astype(np.float32) for direction in ["forward", "backward"]
+        ]
+
+
 class StereoSequenceDataset(data.Dataset):
-    def __init__(self, aug_params=None, sparse=False, reader=None):
+    def __init__(
+        self, aug_params=None, sparse=False, reader=None, flow_root=None, decode_threads=0
+    ):
         self.augmentor = None
+        # directory with the RAFT flows written by scripts/precompute_flows.py
+        self.flow_root = flow_root
         self.sparse = sparse
         self.img_pad = (
             aug_params.pop("img_pad", None) if aug_params is not None else None
@@ -61,6 +112,44 @@ class StereoSequenceDataset(data.Dataset):
         self.sample_list = []
         self.extra_info = []
         self.depth_eps = 1e-5
+        # ShardReader with the decoded frames for the "shard" backend, samples
+        # then also hold the sequence and the slice of their frames as "shard"
+        self.shards = None
+        # threads decoding the frames of a sample in parallel, 0 or 1 decodes
+        # them one after another
+        self.decode_threads = decode_threads
+        self._decode_pool = None
+        self._decode_pool_pid = None
+
+    def __getstate__(self):
+        # copies and worker processes start their own pool
+        state = self.__dict__.copy()
+        state["_decode_pool"] = None
+        return state
+
+    def _get_decode_pool(self):
+        if self.decode_threads <= 1:
+            return None
+        # a forked DataLoader worker has none of the threads of its parent
+        if self._decode_pool is None or self._decode_pool_pid != os.getpid():
+            self._decode_pool = ThreadPoolExecutor(self.decode_threads)
+            self._decode_pool_pid = os.getpid()
+        return self._decode_pool
+
+    def _decode(self, tasks):
+        """Results of the (reader, path) tasks, PIL and cv2 release the GIL."""
+        pool = self._get_decode_pool()
+        if pool is None:
+            return [reader(path) for reader, path in tasks]
+        return list(pool.map(lambda task: task[0](task[1]), tasks))
+
+    def _open_shards(self, backend, shard_root):
+        if backend == "shard":
+            if shard_root is None:
+                raise ValueError("The shard backend needs a shard_root")
+            self.shards = ShardReader(shard_root)
+        elif backend != "files":
+            raise ValueError(f"Unknown backend {backend}")
 
     def _load_16big_png_depth(self, depth_png):
         with Image.open(depth_png) as depth_pil:
@@ -77,6 +166,11 @@ class StereoSequenceDataset(data.Dataset):
         self, entry_viewpoint, image_size, scale: float
     ) -> PerspectiveCameras:
         assert entry_viewpoint is not None
+        if isinstance(entry_viewpoint, np.void):
+            # a row of the viewpoints of DynamicReplicaDataset._load_sequences
+            entry_viewpoint = ViewpointAnnotation(
+                **{f: entry_viewpoint[f].tolist() for f in entry_viewpoint.dtype.names}
+            )
         # principal point and focal length
         principal_point = torch.tensor(
             entry_viewpoint.principal_point, dtype=torch.float
@@ -133,6 +227,13 @@ class StereoSequenceDataset(data.Dataset):
         for key in output_tensor_keys:
             output_tensor[key] = [[] for _ in range(sample_size)]
 
+        shard_images = shard_disparity = None
+        if "shard" in sample:
+            # views of the memory-mapped shard, only the used frames are read
+            frames = sample["shard"]["frames"]
+            shard_images = self.shards.images(sample["shard"]["sequence"])[frames]
+            shard_disparity = self.shards.disparity(sample["shard"]["sequence"])[frames]
+
         if "viewpoint" in sample:
             viewpoint_left = self._get_pytorch3d_camera(
                 sample["viewpoint"]["left"][0],
@@ -150,12 +251,43 @@ class StereoSequenceDataset(data.Dataset):
                 torch.Tensor(sample["metadata"]["left"][0][1])[None],
             )
 
+        # the files of all frames are decoded before they are processed
+        columns = []
+        for cam in ["left", "right"]:
+            if "mask" in sample and cam in sample["mask"]:
+                columns.append(("mask", cam, read_mask))
+            if shard_images is not None:
+                continue
+            if cam in sample["image"]:
+                columns.append(("image", cam, read_image))
+            if cam in sample["disparity"]:
+                columns.append(("disparity", cam, self.disparity_reader))
+            elif "depth" in sample and cam in sample["depth"]:
+                columns.append(("depth", cam, self.depth_reader))
+        tasks = [
+            (reader, path)
+            for k, cam, reader in columns
+            for path in sample[k][cam][:sample_size]
+        ]
+        if self.flow_root is not None:
+            # forward and backward flows between frames i and i + 1 of the right view
+            images = sample["image"]["right"][:sample_size]
+            tasks += [
+                (read_flows, get_flow_path(self.flow_root, self.root, image1, image2))
+                for image1, image2 in zip(images[:-1], images[1:])
+            ]
+        results = iter(self._decode(tasks))
+        decoded = {
+            (k, cam): [next(results) for _ in sample[k][cam][:sample_size]]
+            for k, cam, _ in columns
+        }
+        if self.flow_root is not None:
+            output_tensor["flow"] = list(results)
+
         for i in range(sample_size):
             for cam in ["left", "right"]:
                 if "mask" in sample and cam in sample["mask"]:
-                    mask = frame_utils.read_gen(sample["mask"][cam][i])
-                    mask = np.array(mask) / 255.0
-                    output_tensor["mask"][i].append(mask)
+                    output_tensor["mask"][i].append(decoded["mask", cam][i])
 
                 if "viewpoint" in sample and cam in sample["viewpoint"]:
                     viewpoint = self._get_pytorch3d_camera(
@@ -169,19 +301,22 @@ class StereoSequenceDataset(data.Dataset):
                     metadata = sample["metadata"][cam][i]
                     output_tensor["metadata"][i].append(metadata)
 
-                if cam in sample["image"]:
-                    img = frame_utils.read_gen(sample["image"][cam][i])
-                    img = np.array(img).astype(np.uint8)
+                if shard_images is not None:
+                    cam_idx = 0 if cam == "left" else 1
+                    # copied, the augmentor and torch expect writable arrays
+                    output_tensor["img"][i].append(np.array(shard_images[i, cam_idx]))
+                    disp = shard_disparity[i, cam_idx].astype(np.float32)
+                    valid_disp = disp < 512
+                    disp = np.stack([-disp, np.zeros_like(disp)], axis=-1)
+                    output_tensor["disp"][i].append(disp)
+                    output_tensor["valid_disp"][i].append(valid_disp)
+                    continue
 
-                    # grayscale images
-                    if len(img.shape) == 2:
-                        img = np.tile(img[..., None], (1, 1, 3))
-                    else:
-                        img = img[..., :3]
-                    output_tensor["img"][i].append(img)
+                if cam in sample["image"]:
+                    output_tensor["img"][i].append(decoded["image", cam][i])
 
                 if cam in sample["disparity"]:
-                    disp = self.disparity_reader(sample["disparity"][cam][i])
+                    disp = decoded["disparity", cam][i]
                     if isinstance(disp, tuple):
                         disp, valid_disp = disp
                     else:
@@ -194,7 +329,7 @@ class StereoSequenceDataset(data.Dataset):
                     output_tensor["valid_disp"][i].append(valid_disp)
 
                 elif "depth" in sample and cam in sample["depth"]:
-                    depth = self.depth_reader(sample["depth"][cam][i])
+                    depth = decoded["depth", cam][i]
 
                     depth_mask = depth < self.depth_eps
                     depth[depth_mask] = self.depth_eps
@@ -238,9 +373,11 @@ class StereoSequenceDataset(data.Dataset):
         sample_size = len(sample["image"]["left"])
 
         if self.augmentor is not None:
-            output_tensor["img"], output_tensor["disp"] = self.augmentor(
-                output_tensor["img"], output_tensor["disp"]
+            output_tensor["img"], output_tensor["disp"], flow = self.augmentor(
+                output_tensor["img"], output_tensor["disp"], output_tensor.get("flow")
             )
+            if flow is not None:
+                output_tensor["flow"] = flow
         for i in range(sample_size):
             for cam in (0, 1):
                 if cam < len(output_tensor["img"][i]):
@@ -286,6 +423,14 @@ class StereoSequenceDataset(data.Dataset):
                     viewpoint = output_tensor["viewpoint"][i][cam]
                     output_tensor["viewpoint"][i][cam] = viewpoint
 
+                if "flow" in output_tensor and i < len(output_tensor["flow"]):
+                    flow = (
+                        torch.from_numpy(output_tensor["flow"][i][cam])
+                        .permute(2, 0, 1)
+                        .float()
+                    )
+                    output_tensor["flow"][i][cam] = flow
+
         res = {}
         if "viewpoint" in output_tensor and self.split != "train":
             res["viewpoint"] = output_tensor["viewpoint"]
@@ -319,17 +464,137 @@ class DynamicReplicaDataset(StereoSequenceDataset):
         split="train",
         sample_len=-1,
         only_first_n_samples=-1,
+        flow_root=None,
+        backend="files",
+        shard_root=None,
+        decode_threads=0,
     ):
-        super(DynamicReplicaDataset, self).__init__(aug_params)
+        super(DynamicReplicaDataset, self).__init__(
+            aug_params, flow_root=flow_root, decode_threads=decode_threads
+        )
         self.root = root
         self.sample_len = sample_len
         self.split = split
+        # "files" decodes the PNGs, "shard" reads the shard in <shard_root>/<split>
+        # written by scripts/convert_to_shards.py
+        self._open_shards(
+            backend, osp.join(shard_root, split) if shard_root is not None else None
+        )
+        # the masks are not used for training
+        self.sample_list = SequenceWindows(
+            skip_keys=("mask",) if split == "train" else (),
+            shards=self.shards is not None,
+        )
+
+        for seq_name, filenames in self._load_sequences().items():
+            try:
+                seq_len = len(filenames["image"]["right"])
+                if self.shards is not None:
+                    assert seq_name in self.shards, f"{seq_name} is not in the shard"
+
+                print("seq_len", seq_name, seq_len)
+                seq_id = self.sample_list.add_sequence(seq_name, filenames)
+                if split == "train":
+                    for ref_idx in range(0, seq_len, 3):
+                        step = 1 if self.sample_len == 1 else np.random.randint(1, 6)
+                        if ref_idx + step * self.sample_len < seq_len:
+                            self.sample_list.append(seq_id, ref_idx, step, self.sample_len)
+                else:
+                    step = self.sample_len if self.sample_len > 0 else seq_len
+                    counter = 0
+                    for ref_idx in range(0, seq_len, step):
+                        # the trailing partial window is dropped
+                        if ref_idx + step > seq_len:
+                            break
+                        self.sample_list.append(seq_id, ref_idx, 1, step)
+                        counter += 1
+                        if only_first_n_samples > 0 and counter >= only_first_n_samples:
+                            break
+            except Exception as e:
+                print(e)
+                print("Skipping sequence", seq_name)
+        self.sample_list.freeze()
 
-        frame_annotations_file = f"frame_annotations_{split}.jgz"
+        assert len(self.sample_list) > 0, "No samples found"
+        print(f"Added {len(self.sample_list)} from Dynamic Replica {split}")
+        logging.info(f"Added {len(self.sample_list)} from Dynamic Replica {split}")
+
+    def _load_sequences(self):
+        """
+        Files, viewpoints and metadata of the frames of every valid sequence as
+        {sequence: {key: {camera: [...]}}}. Parsing the annotations and checking
+        the files takes minutes on the train split, so the result is cached as
+        flat arrays next to the annotations, and rebuilt when the modification
+        time or size of the annotation file changes. The viewpoints stay rows of
+        a structured array with the fields of ViewpointAnnotation, which is only
+        built for the frames of a sample (see _get_pytorch3d_camera).
+        """
+        split_root = osp.join(self.root, self.split)
+        annotations_file = osp.join(split_root, f"frame_annotations_{self.split}.jgz")
+        index_file = osp.splitext(annotations_file)[0] + ".index.npz"
+        stat = os.stat(annotations_file)
+        source = np.array(
+            [ANNOTATION_INDEX_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64
+        )
 
-        with gzip.open(
-            osp.join(root, split, frame_annotations_file), "rt", encoding="utf8"
-        ) as zipfile:
+        index = None
+        if osp.isfile(index_file):
+            with np.load(index_file) as cached:
+                if np.array_equal(cached["source"], source):
+                    index = dict(cached)
+        if index is None:
+            index = self._build_annotation_index(annotations_file)
+            index["source"] = source
+            # written under a unique name and renamed, as several processes may
+            # build the same dataset at once
+            tmp_file = f"{index_file}.{os.getpid()}.npz"
+            try:
+                np.savez(tmp_file, **index)
+                os.replace(tmp_file, index_file)
+            except OSError as e:
+                logging.warning(f"Could not cache the annotation index: {e}")
+
+        sequences = {}
+        names = index["sequence"]
+        if len(names) == 0:
+            return sequences
+        fields = ["R", "T", "focal_length", "principal_point", "intrinsics_format"]
+        viewpoints = np.empty(
+            len(names), dtype=[(f, index[f].dtype, index[f].shape[1:]) for f in fields]
+        )
+        for f in fields:
+            viewpoints[f] = index[f]
+        # the frames of a sequence are contiguous, those of the left camera first
+        starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])
+        ends = np.r_[starts[1:], len(names)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            seq_name = str(names[start])
+            filenames = defaultdict(lambda: defaultdict(list))
+            for cam_idx, cam in enumerate(["left", "right"]):
+                frames = start + np.flatnonzero(index["camera"][start:end] == cam_idx)
+                filenames["image"][cam] = [
+                    osp.join(split_root, path) for path in index["image"][frames].tolist()
+                ]
+                if index["has_depth"][frames].all():
+                    filenames["depth"][cam] = [
+                        osp.join(split_root, path) for path in index["depth"][frames].tolist()
+                    ]
+                filenames["mask"][cam] = [
+                    osp.join(split_root, path) for path in index["mask"][frames].tolist()
+                ]
+                filenames["viewpoint"][cam] = viewpoints[frames]
+                filenames["metadata"][cam] = [
+                    [seq_name, size] for size in index["image_size"][frames].tolist()
+                ]
+            sequences[seq_name] = filenames
+        return sequences
+
+    def _build_annotation_index(self, annotations_file):
+        """
+        Parse the frame annotations into flat arrays with one entry per frame,
+        paths are relative to the split. Sequences with missing files are skipped.
+        """
+        with gzip.open(annotations_file, "rt", encoding="utf8") as zipfile:
             frame_annots_list = load_dataclass(
                 zipfile, List[DynamicReplicaFrameAnnotation]
             )
@@ -340,77 +605,52 @@ class DynamicReplicaDataset(StereoSequenceDataset):
                 frame_annot
             )
 
+        split_root = osp.join(self.root, self.split)
+        columns = defaultdict(list)
         for seq_name in seq_annot.keys():
             try:
-                filenames = defaultdict(lambda: defaultdict(list))
-                for cam in ["left", "right"]:
+                frames = []
+                for cam_idx, cam in enumerate(["left", "right"]):
+                    assert len(seq_annot[seq_name][cam]) > 0, seq_name
                     for framedata in seq_annot[seq_name][cam]:
-                        im_path = osp.join(root, split, framedata.image.path)
-                        depth_path = osp.join(root, split, framedata.depth.path)
-                        mask_path = osp.join(root, split, framedata.mask.path)
+                        im_path = osp.join(split_root, framedata.image.path)
+                        depth_path = osp.join(split_root, framedata.depth.path)
+                        mask_path = osp.join(split_root, framedata.mask.path)
 
                         assert os.path.isfile(im_path), im_path
                         if self.split == 'train':
                             assert os.path.isfile(depth_path), depth_path
                         assert os.path.isfile(mask_path), mask_path
+                        frames.append((cam_idx, framedata, os.path.isfile(depth_path)))
 
-                        filenames["image"][cam].append(im_path)
-                        if os.path.isfile(depth_path):
-                            filenames["depth"][cam].append(depth_path)
-                        filenames["mask"][cam].append(mask_path)
-
-                        filenames["viewpoint"][cam].append(framedata.viewpoint)
-                        filenames["metadata"][cam].append(
-                            [framedata.sequence_name, framedata.image.size]
-                        )
-
-                        for k in filenames.keys():
-                            assert (
-                                len(filenames[k][cam])
-                                == len(filenames["image"][cam])
-                                > 0
-                            ), framedata.sequence_name
-
-                seq_len = len(filenames["image"][cam])
-
-                print("seq_len", seq_name, seq_len)
-                if split == "train":
-                    for ref_idx in range(0, seq_len, 3):
-                        step = 1 if self.sample_len == 1 else np.random.randint(1, 6)
-                        if ref_idx + step * self.sample_len < seq_len:
-                            sample = defaultdict(lambda: defaultdict(list))
-                            for cam in ["left", "right"]:
-                                for idx in range(
-                                    ref_idx, ref_idx + step * self.sample_len, step
-                                ):
-                                    for k in filenames.keys():
-                                        if "mask" not in k:
-                                            sample[k][cam].append(
-                                                filenames[k][cam][idx]
-                                            )
-
-                            self.sample_list.append(sample)
-                else:
-                    step = self.sample_len if self.sample_len > 0 else seq_len
-                    counter = 0
-                    for ref_idx in range(0, seq_len, step):
-                        sample = defaultdict(lambda: defaultdict(list))
-                        for cam in ["left", "right"]:
-                            for idx in range(ref_idx, ref_idx + step):
-                                for k in filenames.keys():
-                                    sample[k][cam].append(filenames[k][cam][idx])
-
-                        self.sample_list.append(sample)
-                        counter += 1
-                        if only_first_n_samples > 0 and counter >= only_first_n_samples:
-                            break
+                # the depths of a sequence are used if all of them exist, as before
+                # the index a sequence with only some depths is skipped
+                has_depth = [frame[2] for frame in frames]
+                assert all(has_depth) or not any(has_depth), seq_name
             except Exception as e:
                 print(e)
                 print("Skipping sequence", seq_name)
-
-        assert len(self.sample_list) > 0, "No samples found"
-        print(f"Added {len(self.sample_list)} from Dynamic Replica {split}")
-        logging.info(f"Added {len(self.sample_list)} from Dynamic Replica {split}")
+                continue
+
+            for cam_idx, framedata, frame_has_depth in frames:
+                viewpoint = framedata.viewpoint
+                columns["sequence"].append(seq_name)
+                columns["camera"].append(cam_idx)
+                columns["image"].append(framedata.image.path)
+                columns["depth"].append(framedata.depth.path)
+                columns["mask"].append(framedata.mask.path)
+                columns["has_depth"].append(frame_has_depth)
+                columns["image_size"].append(list(framedata.image.size))
+                columns["R"].append(viewpoint.R)
+                columns["T"].append(viewpoint.T)
+                columns["focal_length"].append(viewpoint.focal_length)
+                columns["principal_point"].append(viewpoint.principal_point)
+                columns["intrinsics_format"].append(viewpoint.intrinsics_format)
+
+        index = {k: np.array(v) for k, v in columns.items()}
+        if len(columns) == 0:
+            index = {"sequence": np.array([], dtype=str)}
+        return index
 
 
 class SequenceSceneFlowDataset(StereoSequenceDataset):
@@ -424,11 +664,23 @@ class SequenceSceneFlowDataset(StereoSequenceDataset):
         add_things=True,
         add_monkaa=True,
         add_driving=True,
+        flow_root=None,
+        backend="files",
+        shard_root=None,
+        decode_threads=0,
     ):
-        super(SequenceSceneFlowDataset, self).__init__(aug_params)
+        super(SequenceSceneFlowDataset, self).__init__(
+            aug_params, flow_root=flow_root, decode_threads=decode_threads
+        )
         self.root = root
         self.dstype = dstype
         self.sample_len = sample_len
+        # "files" decodes the PNGs and PFMs, "shard" reads the shard in
+        # <shard_root>/<dstype> written by scripts/convert_to_shards.py
+        self._open_shards(
+            backend, osp.join(shard_root, dstype) if shard_root is not None else None
+        )
+        self.sample_list = SequenceWindows(shards=self.shards is not None)
         if things_test:
             self._add_things("TEST")
         else:
@@ -438,6 +690,7 @@ class SequenceSceneFlowDataset(StereoSequenceDataset):
                 self._add_monkaa()
             if add_driving:
                 self._add_driving()
+        self.sample_list.freeze()
 
     def _add_things(self, split="TRAIN"):
         """Add FlyingThings3D data"""
@@ -556,20 +809,20 @@ class SequenceSceneFlowDataset(StereoSequenceDataset):
 
     def _append_sample(self, images, disparities):
         seq_len = len(images["left"])
+        if seq_len == 0:
+            return
+        # sequences are named by the directory of their left frames
+        seq_name = osp.relpath(osp.dirname(images["left"][0]), self.root)
+        if self.shards is not None and seq_name not in self.shards:
+            raise ValueError(f"{seq_name} is not in the shard {self.shards.path}")
+
+        seq_id = self.sample_list.add_sequence(
+            seq_name, {"image": images, "disparity": disparities}
+        )
         for ref_idx in range(0, seq_len - self.sample_len):
-            sample = defaultdict(lambda: defaultdict(list))
-            for cam in ["left", "right"]:
-                for idx in range(ref_idx, ref_idx + self.sample_len):
-                    sample["image"][cam].append(images[cam][idx])
-                    sample["disparity"][cam].append(disparities[cam][idx])
-            self.sample_list.append(sample)
-
-            sample = defaultdict(lambda: defaultdict(list))
-            for cam in ["left", "right"]:
-                for idx in range(ref_idx, ref_idx + self.sample_len):
-                    sample["image"][cam].append(images[cam][seq_len - idx - 1])
-                    sample["disparity"][cam].append(disparities[cam][seq_len - idx - 1])
-            self.sample_list.append(sample)
+            self.sample_list.append(seq_id, ref_idx, 1, self.sample_len)
+            # the same window played backwards from the end of the sequence
+            self.sample_list.append(seq_id, seq_len - ref_idx - 1, -1, self.sample_len)
 
 
 class SequenceSintelStereo(StereoSequenceDataset):
@@ -578,9 +831,13 @@ class SequenceSintelStereo(StereoSequenceDataset):
         dstype="clean",
         aug_params=None,
         root="./data/datasets",
+        decode_threads=0,
     ):
         super().__init__(
-            aug_params, sparse=True, reader=frame_utils.readDispSintelStereo
+            aug_params,
+            sparse=True,
+            reader=frame_utils.readDispSintelStereo,
+            decode_threads=decode_threads,
         )
         self.dstype = dstype
         original_length = len(self.sample_list)
@@ -641,6 +898,12 @@ def fetch_dataloader(args):
         aug_params["do_flip"] = args.do_flip
 
     train_dataset = None
+    flow_root = getattr(args, "flow_root", None)
+    backend = getattr(args, "data_backend", "files")
+    shard_root = getattr(args, "shard_root", None)
+    decode_threads = get_decode_threads(
+        getattr(args, "decode_threads", 0), args.num_workers
+    )
 
     add_monkaa = "monkaa" in args.train_datasets
     add_driving = "driving" in args.train_datasets
@@ -657,6 +920,10 @@ def fetch_dataloader(args):
             add_monkaa=add_monkaa,
             add_driving=add_driving,
             add_things=add_things,
+            flow_root=flow_root,
+            backend=backend,
+            shard_root=shard_root,
+            decode_threads=decode_threads,
         )
 
         final_dataset = SequenceSceneFlowDataset(
@@ -666,13 +933,23 @@ def fetch_dataloader(args):
             add_monkaa=add_monkaa,
             add_driving=add_driving,
             add_things=add_things,
+            flow_root=flow_root,
+            backend=backend,
+            shard_root=shard_root,
+            decode_threads=decode_threads,
         )
 
         new_dataset = clean_dataset + final_dataset
 
     if add_dynamic_replica:
         dr_dataset = DynamicReplicaDataset(
-            aug_params, split="train", sample_len=args.sample_len
+            aug_params,
+            split="train",
+            sample_len=args.sample_len,
+            flow_root=flow_root,
+            backend=backend,
+            shard_root=shard_root,
+            decode_threads=decode_threads,
         )
         if new_dataset is None:
             new_dataset = dr_dataset
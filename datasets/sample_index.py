@@ -0,0 +1,197 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Sample index of the sequence datasets, held in a few numpy buffers.
+
+DataLoader workers are forked from the training process and share its memory
+until a page is written. Indexing a list of samples updates the reference
+counts of the Python objects in it, so over a run every worker ends up with
+its own copy of the index. Here the files of all sequences are packed into
+byte buffers with offset arrays and the windows are rows of integer arrays,
+so only a handful of Python objects are shared.
+"""
+
+import copy
+import pickle
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+from bidastereo.datasets.shards import frame_slice
+
+
+class PackedTable:
+    """
+    Append-only list of strings, or of picklable objects if `pickled`, stored
+    in one byte buffer and an array of offsets.
+    """
+
+    def __init__(self, pickled=False):
+        self.pickled = pickled
+        self.data = bytearray()
+        self.offsets = array("q", [0])
+
+    def append(self, value):
+        """Appends a value, returns its index."""
+        self.data += pickle.dumps(value) if self.pickled else value.encode()
+        self.offsets.append(len(self.data))
+        return len(self) - 1
+
+    def freeze(self):
+        """Moves the table into numpy arrays, nothing can be appended afterwards."""
+        self.data = np.frombuffer(bytes(self.data), dtype=np.uint8)
+        self.offsets = np.array(self.offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        value = bytes(self.data[self.offsets[index] : self.offsets[index + 1]])
+        return pickle.loads(value) if self.pickled else value.decode()
+
+
+class SequenceWindows:
+    """
+    Sample windows over the frames of sequences, a lazy replacement of a list
+    of samples. The files of each sequence are stored once and a window is a
+    (sequence, start, step, length) record in flat arrays, its sample
+    {key: {camera: [...]}} is built when it is indexed. A negative step is a
+    window played backwards from start.
+
+    Every {key: {camera: [...]}} list of a sequence is an entry. Paths are
+    stored frame by frame in a string table, any other values (metadata) frame
+    by frame in a table of pickles and numpy arrays (e.g. the viewpoints of
+    Dynamic Replica) as rows of one array per column, so that a window only
+    reads its own frames. freeze() has to be called once all windows are
+    added, before the dataset is used by the DataLoader.
+    """
+
+    # integer arrays, moved into numpy arrays by freeze()
+    ARRAYS = (
+        "first_entry",
+        "entry_columns",
+        "entry_starts",
+        "entry_lengths",
+        "sequence_ids",
+        "starts",
+        "steps",
+        "lengths",
+    )
+
+    def __init__(self, skip_keys=(), shards=False):
+        # keys of the sequences left out of the samples
+        self.skip_keys = skip_keys
+        # samples also get the "shard" entry of the shard backend
+        self.shards = shards
+        self.names = PackedTable()
+        self.strings = PackedTable()
+        self.objects = PackedTable(pickled=True)
+        # (key, camera, kind) of the entries, kind is "strings", "objects" or "array"
+        self.columns = []
+        # rows of the "array" columns by column index, concatenated by freeze()
+        self.arrays = {}
+        # entries of sequence i are first_entry[i]:first_entry[i + 1]
+        self.first_entry = array("q", [0])
+        self.entry_columns = array("q")
+        self.entry_starts = array("q")
+        self.entry_lengths = array("q")
+        self.sequence_ids = array("q")
+        self.starts = array("q")
+        self.steps = array("q")
+        self.lengths = array("q")
+
+    def add_sequence(self, name, filenames):
+        """Stores the {key: {camera: [...]}} files of a sequence, returns its id."""
+        for k, cameras in filenames.items():
+            for cam, values in cameras.items():
+                if isinstance(values, np.ndarray):
+                    kind = "array"
+                elif all(isinstance(value, str) for value in values):
+                    kind = "strings"
+                else:
+                    kind = "objects"
+                column = (k, cam, kind)
+                if column not in self.columns:
+                    self.columns.append(column)
+                column_index = self.columns.index(column)
+                if kind == "array":
+                    rows = self.arrays.setdefault(column_index, [])
+                    start = sum(len(array) for array in rows)
+                    rows.append(values)
+                else:
+                    table = self.strings if kind == "strings" else self.objects
+                    start = len(table)
+                    for value in values:
+                        table.append(value)
+                self.entry_columns.append(column_index)
+                self.entry_starts.append(start)
+                self.entry_lengths.append(len(values))
+        self.first_entry.append(len(self.entry_starts))
+        return self.names.append(name)
+
+    def append(self, sequence_id, start, step, length):
+        self.sequence_ids.append(sequence_id)
+        self.starts.append(start)
+        self.steps.append(step)
+        self.lengths.append(length)
+
+    def freeze(self):
+        for table in (self.names, self.strings, self.objects):
+            table.freeze()
+        for column_index, rows in self.arrays.items():
+            self.arrays[column_index] = np.concatenate(rows)
+        for name in self.ARRAYS:
+            setattr(self, name, np.array(getattr(self, name), dtype=np.int64))
+
+    def files(self, sequence_id, frames=slice(None), skip_keys=()):
+        """{key: {camera: [...]}} of the given frames of a sequence."""
+        files = defaultdict(lambda: defaultdict(list))
+        entries = range(self.first_entry[sequence_id], self.first_entry[sequence_id + 1])
+        for entry in entries:
+            column_index = self.entry_columns[entry]
+            k, cam, kind = self.columns[column_index]
+            if k in skip_keys:
+                continue
+            start = int(self.entry_starts[entry])
+            if kind == "array":
+                end = start + self.entry_lengths[entry]
+                files[k][cam] = self.arrays[column_index][start:end][frames]
+            else:
+                table = self.strings if kind == "strings" else self.objects
+                indices = range(start, start + self.entry_lengths[entry])[frames]
+                files[k][cam] = [table[i] for i in indices]
+        return files
+
+    def sequence_items(self):
+        """(name, files) of every sequence."""
+        for sequence_id in range(len(self.names)):
+            yield self.names[sequence_id], self.files(sequence_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        sequence_id = int(self.sequence_ids[index])
+        frames = frame_slice(
+            int(self.starts[index]), int(self.steps[index]), int(self.lengths[index])
+        )
+        sample = self.files(sequence_id, frames, self.skip_keys)
+        if self.shards:
+            sample["shard"] = {"sequence": self.names[sequence_id], "frames": frames}
+        return sample
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __rmul__(self, v):
+        # the sequences are shared, only the windows are repeated
+        repeated = copy.copy(self)
+        for name in ("sequence_ids", "starts", "steps", "lengths"):
+            setattr(repeated, name, np.tile(getattr(self, name), v))
+        return repeated
@@ -0,0 +1,120 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Packed shards of stereo sequences, written by scripts/convert_to_shards.py.
+
+A shard is a directory with two flat binary files and an index:
+
+    images.bin     uint8 frames [T, 2, H, W, 3] of every sequence, left view first
+    disparity.bin  float16 disparities [T, 2, H, W] of every sequence
+    index.json     {sequence: {num_frames, height, width, image_offset, disparity_offset}}
+
+Offsets are in bytes. Both files are memory-mapped, so the frames of a window
+are a view of the page cache and nothing has to be decoded.
+"""
+
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+IMAGE_FILE = "images.bin"
+DISPARITY_FILE = "disparity.bin"
+
+
+def frame_slice(start, step, length):
+    """Slice of `length` frames from `start` with `step`, which may be negative."""
+    stop = start + step * length
+    return slice(start, stop if stop >= 0 else None, step)
+
+
+class ShardWriter:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.index = {}
+        self.image_file = open(osp.join(path, IMAGE_FILE), "wb")
+        self.disparity_file = open(osp.join(path, DISPARITY_FILE), "wb")
+
+    def add_sequence(self, name, chunks):
+        """
+        Append a sequence given as consecutive chunks of frames, each a tuple of
+        uint8 images [N, 2, H, W, 3] and disparities [N, 2, H, W].
+        """
+        entry = {
+            "num_frames": 0,
+            "image_offset": self.image_file.tell(),
+            "disparity_offset": self.disparity_file.tell(),
+        }
+        for images, disparities in chunks:
+            height, width = images.shape[2:4]
+            assert entry.setdefault("height", height) == height, name
+            assert entry.setdefault("width", width) == width, name
+            assert disparities.shape == images.shape[:4], (name, disparities.shape)
+            self.image_file.write(np.ascontiguousarray(images, dtype=np.uint8).tobytes())
+            self.disparity_file.write(
+                np.ascontiguousarray(disparities, dtype=np.float16).tobytes()
+            )
+            entry["num_frames"] += len(images)
+        self.index[name] = entry
+
+    def close(self):
+        self.image_file.close()
+        self.disparity_file.close()
+        # written last, an interrupted conversion leaves no usable shard
+        with open(osp.join(self.path, INDEX_FILE), "w") as f:
+            json.dump(self.index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader:
+    def __init__(self, path):
+        self.path = path
+        with open(osp.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self._images = None
+        self._disparity = None
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getstate__(self):
+        # copies and worker processes map the files again instead of copying them
+        state = self.__dict__.copy()
+        state["_images"] = None
+        state["_disparity"] = None
+        return state
+
+    def _open(self):
+        if self._images is None:
+            self._images = np.memmap(osp.join(self.path, IMAGE_FILE), dtype=np.uint8, mode="r")
+            self._disparity = np.memmap(
+                osp.join(self.path, DISPARITY_FILE), dtype=np.float16, mode="r"
+            )
+
+    def images(self, name):
+        """Read-only uint8 view [T, 2, H, W, 3] of the frames of a sequence."""
+        self._open()
+        entry = self.index[name]
+        shape = (entry["num_frames"], 2, entry["height"], entry["width"], 3)
+        start = entry["image_offset"]
+        return self._images[start : start + int(np.prod(shape))].reshape(shape)
+
+    def disparity(self, name):
+        """Read-only float16 view [T, 2, H, W] of the disparities of a sequence."""
+        self._open()
+        entry = self.index[name]
+        shape = (entry["num_frames"], 2, entry["height"], entry["width"])
+        start = entry["disparity_offset"] // self._disparity.itemsize
+        return self._disparity[start : start + int(np.prod(shape))].reshape(shape)
@@ -51,6 +51,7 @@ class Evaluator(Configurable):
         exp_dir=None,
     ):
         model.eval()
+        device = next(model.parameters()).device
         per_batch_eval_results = []
 
         if self.visualize_interval > 0:
@@ -122,7 +123,7 @@ class Evaluator(Configurable):
                     torch.tensor([pred_disp.shape[2], pred_disp.shape[3]])[None],
                 )
 
-                perception_prediction.depth_map = (scale / pred_disp).cuda()
+                perception_prediction.depth_map = (scale / pred_disp).to(device)
                 perspective_cameras = []
                 for cam in sequence["viewpoint"]:
                     perspective_cameras.append(cam[0])
@@ -136,7 +137,7 @@ class Evaluator(Configurable):
 
                 for k, v in batch_dict.items():
                     if isinstance(v, torch.Tensor):
-                        batch_dict[k] = v.cuda()
+                        batch_dict[k] = v.to(device)
 
                 visualize_batch(
                     batch_dict,
@@ -37,6 +37,8 @@ class DefaultConfig:
 
     sample_len: int = -1
     dstype: Optional[str] = None
+    # threads decoding the frames of a sequence, -1 uses all CPU cores
+    decode_threads: int = 0
     # clean, final
     MODEL: Dict[str, Any] = field(
         default_factory=lambda: get_all_model_default_configs()
@@ -75,16 +77,23 @@ def run_eval(cfg: DefaultConfig):
     np.random.seed(cfg.seed)
     evaluator = Evaluator(**cfg.EVALUATOR)
 
+    # the model is placed on MODEL.<model>.device by the model zoo
     model = model_zoo(**cfg.MODEL)
-    model.cuda(0)
     evaluator.setup_visualization(cfg)
 
+    # the sequences are loaded in the main process
+    decode_threads = datasets.get_decode_threads(cfg.decode_threads, num_workers=0)
     if cfg.dataset_name == "dynamicreplica":
         test_dataloader = datasets.DynamicReplicaDataset(
-            split="test", sample_len=cfg.sample_len, only_first_n_samples=1
+            split="test",
+            sample_len=cfg.sample_len,
+            only_first_n_samples=1,
+            decode_threads=decode_threads,
         )
     elif cfg.dataset_name == "sintel":
-        test_dataloader = datasets.SequenceSintelStereo(dstype=cfg.dstype)
+        test_dataloader = datasets.SequenceSintelStereo(
+            dstype=cfg.dstype, decode_threads=decode_threads
+        )
     elif cfg.dataset_name == "things":
         test_dataloader = datasets.SequenceSceneFlowDatasets(
             {},
@@ -154,6 +163,12 @@ def run_eval(cfg: DefaultConfig):
     with open(result_file, "w") as f:
         json.dump(aggreegate_result, f)
 
+    profiler = getattr(model, "profiler", None)
+    if profiler is not None:
+        profile_file = os.path.join(cfg.exp_dir, "profile_eval.json")
+        print(f"Dumping the stage profile to {profile_file}.")
+        profiler.dump(profile_file)
+
 
 cs = hydra.core.config_store.ConfigStore.instance()
 cs.store(name="default_config_eval", node=DefaultConfig)
@@ -282,7 +282,7 @@ def visualize_batch(
             median_depth = preds.depth_map[finite_depth].median()
         else:
             median_depth = torch.tensor(1.0, device=device)
-        cam_.cuda()
+        cam_.to(device)
 
         for mode in ["angle_15", "angle_-15", "changing_angle"]:
         # for mode in ["angle_15"]:
@@ -4,11 +4,12 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import ClassVar
+from typing import ClassVar, Tuple
 
 import torch
 from pytorch3d.implicitron.tools.config import Configurable
-from bidastereo.models.core.bidastereo import BiDAStereo
+from bidastereo.models.core.bidastereo import BiDAStereo, BiDAStereoStream
+from bidastereo.models.core.utils.profiler import StageProfiler
 
 
 class BiDAStereoModel(Configurable, torch.nn.Module):
@@ -17,15 +18,60 @@ class BiDAStereoModel(Configurable, torch.nn.Module):
     model_weights: str = ""
     type: str = "bidastereo"
     kernel_size: int = 20
+    # "trim" keeps the most central prediction of each frame, "linear" and
+    # "cosine" blend the overlapping windows, which advance by `stride` frames
+    # (kernel_size // 2 if 0)
+    stitching: str = "trim"
+    stride: int = 0
+    # disparities of a video are written into pinned memory, or into a
+    # temporary memory-mapped file in output_dir to bound host memory
+    pin_output: bool = False
+    output_dir: str = ""
+    device: str = "cuda"
+    # "fp32", "fp16" (GPU) or "bf16" autocast, see BiDAStereo for the tensors
+    # that are kept in fp32
+    precision: str = "fp32"
+    # CPU only, 0 keeps the PyTorch default of one thread per physical core
+    num_threads: int = 0
+    # pyramid levels (4, 8, 16) correlated through precomputed volumes
+    corr_volume_levels: Tuple[int, ...] = ()
+    max_corr_volume_elements: int = 2 ** 28
+    # image pairs per RAFT call, 0 runs all pairs of a window at once
+    raft_batch_size: int = 8
+    # RAFT alignment flow: refinement iterations and input downscale (1, 2, 4)
+    raft_iters: int = 10
+    raft_downscale: int = 1
+    # early exit of the refinement levels once the disparity update is below
+    # the threshold (0 disables), bounds are per (1/16, 1/8, 1/4) level
+    early_exit_threshold: float = 0.0
+    early_exit_metric: str = "mean"
+    early_exit_min_iters: Tuple[int, int, int] = (1, 1, 1)
+    early_exit_max_iters: Tuple[int, ...] = ()
+    # sliding windows run as one batch, bounded by the free device memory
+    max_batch_windows: int = 1
+    # record the time and peak memory of the model stages in self.profiler
+    profile: bool = False
 
     def __post_init__(self):
         super().__init__()
 
-        self.mixed_precision = False
+        if self.device == "cpu" and self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
 
         if self.type == 'bidastereo':
             model = BiDAStereo(
-                mixed_precision=self.mixed_precision,
+                device=self.device,
+                precision=self.precision,
+                corr_volume_levels=self.corr_volume_levels,
+                max_corr_volume_elements=self.max_corr_volume_elements,
+                raft_batch_size=self.raft_batch_size,
+                raft_iters=self.raft_iters,
+                raft_downscale=self.raft_downscale,
+                early_exit_threshold=self.early_exit_threshold,
+                early_exit_metric=self.early_exit_metric,
+                early_exit_min_iters=self.early_exit_min_iters,
+                early_exit_max_iters=self.early_exit_max_iters,
+                max_batch_windows=self.max_batch_windows,
             )
         else:
             raise ValueError("Wrong Model!")
@@ -39,10 +85,24 @@ class BiDAStereoModel(Configurable, torch.nn.Module):
         model.load_state_dict(state_dict, strict=True)
 
         self.model = model
-        self.model.to("cuda")
+        self.model.to(self.device)
         self.model.eval()
 
+        self.profiler = StageProfiler(self.device) if self.profile else None
+        self.model.profiler = self.profiler
+
     def forward(self, batch_dict, iters=20):
         return self.model.forward_batch_test(
-            batch_dict, kernel_size=self.kernel_size, iters=iters
-        )
\ No newline at end of file
+            batch_dict,
+            kernel_size=self.kernel_size,
+            iters=iters,
+            stitching=self.stitching,
+            stride=self.stride,
+            pin_memory=self.pin_output,
+            output_dir=self.output_dir,
+        )
+
+    def stream(self, iters=20):
+        return BiDAStereoStream(
+            self.model, kernel_size=self.kernel_size, iters=iters
+        )
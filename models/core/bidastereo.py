@@ -3,34 +3,108 @@ from einops import rearrange
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import importlib
 import sys
+import tempfile
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from bidastereo.models.core.update import (
     MultiSequenceUpdateBlock3D,
 )
 from bidastereo.models.core.extractor import BasicEncoder, ResidualBlock
-from bidastereo.models.core.corr import TFCL
+from bidastereo.models.core.corr import build_tfcl
 
-from bidastereo.models.core.utils.utils import InputPadder, interp
+from bidastereo.models.core.utils.utils import InputPadder, interp, flow_warp
+from bidastereo.models.core.utils.profiler import (
+    NO_PROFILING,
+    PeakMemory,
+    available_memory,
+)
 from bidastereo.models.raft_model import RAFTModel
 
-autocast = torch.cuda.amp.autocast
+# autocast dtype of each precision policy, None runs in fp32
+AUTOCAST_DTYPES = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
 
 
 class BiDAStereo(nn.Module):
-    def __init__(self, mixed_precision = False):
+    def __init__(
+        self,
+        mixed_precision = False,
+        device="cuda",
+        precision="fp32",
+        corr_volume_levels=(),
+        max_corr_volume_elements=2 ** 28,
+        raft_batch_size=8,
+        raft_iters=10,
+        raft_downscale=1,
+        raft_weights="./third_party/RAFT/models/raft-sintel.pth",
+        early_exit_threshold=0.0,
+        early_exit_metric="mean",
+        early_exit_min_iters=(1, 1, 1),
+        early_exit_max_iters=(),
+        max_batch_windows=1,
+    ):
         super(BiDAStereo, self).__init__()
 
-        self.mixed_precision = mixed_precision
+        self.device = torch.device(device)
+        # "fp32", or autocast to "fp16" (GPU only) or "bf16". RAFT flows, feature
+        # warping, correlation and the disparity itself always stay in fp32, only
+        # the convolutions of the encoder and update block (and thus the GRU
+        # hidden states) run in the lower precision. mixed_precision is the fp16
+        # policy used for training, it is ignored on the CPU
+        if precision not in AUTOCAST_DTYPES:
+            raise ValueError(f"Unknown precision {precision}")
+        if precision == "fp16" and self.device.type != "cuda":
+            raise ValueError("fp16 autocast needs a GPU, use bf16 on the CPU")
+        if precision == "fp32" and mixed_precision and self.device.type == "cuda":
+            precision = "fp16"
+        self.precision = precision
 
         self.hidden_dim = 128
         self.context_dim = 128
         self.dropout = 0
 
-        self.raft = RAFTModel()
+        # pyramid levels (4, 8, 16) that use precomputed correlation volumes,
+        # levels whose volumes exceed the budget are correlated on the fly
+        self.corr_volume_levels = tuple(corr_volume_levels)
+        self.max_corr_volume_elements = max_corr_volume_elements
+
+        # image pairs per RAFT call, bounds the memory of its correlation
+        # volumes, 0 runs all pairs of a window at once
+        self.raft_batch_size = raft_batch_size
+
+        self.raft = RAFTModel(
+            device=device, iters=raft_iters, downscale=raft_downscale, model_weights=raft_weights
+        )
+
+        # at inference, a refinement level stops once the "mean" or "max" disparity
+        # update (in full resolution pixels) is below the threshold, 0 disables it.
+        # Iteration bounds are given for the (1/16, 1/8, 1/4) levels, the maximum
+        # defaults to the (iters // 2, iters // 2, iters) schedule
+        if early_exit_metric not in ("mean", "max"):
+            raise ValueError(f"Unknown early exit metric {early_exit_metric}")
+        self.early_exit_threshold = early_exit_threshold
+        self.early_exit_metric = early_exit_metric
+        self.early_exit_min_iters = tuple(early_exit_min_iters)
+        self.early_exit_max_iters = tuple(early_exit_max_iters)
+
+        # sliding windows of forward_batch_test stacked into one forward call,
+        # further limited by the memory of the first window, 1 runs them one by one
+        self.max_batch_windows = max_batch_windows
+        # measured memory of a window by (kernel_size, height, width), reused
+        # by later videos of the same size
+        self.window_memory = {}
+
+        # CUDA stream of the host to device copies of run_windows, created lazily
+        self.copy_stream = None
+
+        # StageProfiler timing the stages of forward, None disables profiling
+        self.profiler = None
 
         # feature network and update block
         self.fnet = BasicEncoder(output_dim=256, norm_fn='instance', dropout=self.dropout)
@@ -45,144 +119,473 @@ class BiDAStereo(nn.Module):
             if isinstance(m, nn.BatchNorm2d):
                 m.eval()
 
+    @property
+    def mixed_precision(self):
+        return self.precision != "fp32"
+
+    def autocast(self, enabled=True):
+        """Autocast context of the precision policy, disabled for fp32 or if not `enabled`."""
+        dtype = AUTOCAST_DTYPES[self.precision]
+        return torch.autocast(
+            self.device.type, dtype=dtype, enabled=enabled and dtype is not None
+        )
+
+    def profile(self, name):
+        if self.profiler is None:
+            return NO_PROFILING
+        return self.profiler.region(name)
+
     def convex_upsample(self, flow, mask, rate=4):
         """ Upsample flow field [H/rate, W/rate, 2] -> [H, W, 2] using convex combination """
-        N, _, H, W = flow.shape
-        mask = mask.view(N, 1, 9, rate, rate, H, W)
-        mask = torch.softmax(mask, dim=2)
+        with self.profile("convex_upsample"):
+            N, _, H, W = flow.shape
+            mask = mask.view(N, 1, 9, rate, rate, H, W)
+            mask = torch.softmax(mask, dim=2)
 
-        up_flow = F.unfold(rate * flow, [3, 3], padding=1)
-        up_flow = up_flow.view(N, 2, 9, 1, 1, H, W)
+            up_flow = F.unfold(rate * flow, [3, 3], padding=1)
+            up_flow = up_flow.view(N, 2, 9, 1, 1, H, W)
 
-        up_flow = torch.sum(mask * up_flow, dim=2)
-        up_flow = up_flow.permute(0, 1, 4, 2, 5, 3)
-        return up_flow.reshape(N, 2, rate * H, rate * W)
+            up_flow = torch.sum(mask * up_flow, dim=2)
+            up_flow = up_flow.permute(0, 1, 4, 2, 5, 3)
+            return up_flow.reshape(N, 2, rate * H, rate * W)
 
     def zero_init(self, fmap):
         N, C, H, W = fmap.shape
-        flow_u = torch.zeros([N, 1, H, W], dtype=torch.float)
-        flow_v = torch.zeros([N, 1, H, W], dtype=torch.float)
-        flow = torch.cat([flow_u, flow_v], dim=1).to(fmap.device)
+        flow = torch.zeros([N, 2, H, W], dtype=torch.float, device=fmap.device)
         return flow
 
+    def has_converged(self, delta_flow, rate):
+        delta = rate * delta_flow[:, :1].float().abs()
+        delta = delta.mean() if self.early_exit_metric == "mean" else delta.max()
+        return delta.item() < self.early_exit_threshold
+
+    def build_corr_fn(self, fmap1, fmap2, level):
+        return build_tfcl(
+            fmap1,
+            fmap2,
+            volume=level in self.corr_volume_levels,
+            max_volume_elements=self.max_corr_volume_elements,
+        )
+
     def forward_batch_test(
-        self, batch_dict: Dict, kernel_size: int = 14, iters: int = 20
+        self,
+        batch_dict: Dict,
+        kernel_size: int = 14,
+        iters: int = 20,
+        stitching: str = "trim",
+        stride: int = 0,
+        pin_memory: bool = False,
+        output_dir: str = "",
     ):
-        disp_preds = []
+        """
+        Disparities of a whole video, run in sliding windows of `kernel_size`
+        frames when it is longer than that. With "trim" stitching the windows
+        advance by kernel_size // 2 frames and each frame is taken from the
+        window in which it is most central. "linear" and "cosine" stitching
+        average the overlapping predictions with weights that ramp down towards
+        the window edges, the windows then advance by `stride` frames
+        (kernel_size // 2 if 0), so a larger stride trades overlap for speed.
+
+        Every window is written straight into one [T, 1, H, W] output tensor,
+        optionally in pinned memory or memory-mapped from a temporary file in
+        `output_dir` (see allocate_output). Only "trim" stitching into a pinned
+        output copies the disparities from a GPU asynchronously, overlapping the
+        next windows. Blending and unpinned outputs wait for every copy.
+        """
+        if stitching not in ("trim", "linear", "cosine"):
+            raise ValueError(f"Unknown stitching {stitching}")
         predictions = defaultdict(list)
         video = batch_dict["stereo_video"]
         num_ims = len(video)
         print("video", video.shape)
+        # refinement iterations used by each window when exiting early
+        iterations = [] if self.early_exit_threshold > 0 else None
+        disparity = self.allocate_output(
+            (num_ims, 1, *video.shape[-2:]), pin_memory=pin_memory, output_dir=output_dir
+        )
         if kernel_size >= num_ims:
-            left_ims = video[:, 0]
-            right_ims = video[:, 1]
-            padder = InputPadder(left_ims.shape, divis_by=32)
-            left_ims, right_ims = padder.pad(left_ims, right_ims)
-
-            with autocast(enabled=self.mixed_precision):
-                disparities_forw = self.forward(
-                    left_ims[None].cuda(),
-                    right_ims[None].cuda(),
-                    iters=iters,
-                    test_mode=True,
-                )
-            disparities_forw = padder.unpad(disparities_forw[:, 0])[:, None].cpu()
-            disp_preds.append(disparities_forw)
-
-            predictions["disparity"] = (torch.cat(disp_preds).squeeze(1).abs())[:, :1]
-            print(predictions["disparity"].shape)
-
-            return predictions
+            disparities_forw = self.forward_window(
+                video[:, 0], video[:, 1], iters=iters, iterations=iterations, to_cpu=False
+            )
+            disparity.copy_(disparities_forw[:, 0, :1]).abs_()
+
+        elif stitching != "trim":
+            stride = stride if stride > 0 else kernel_size // 2
+            if stride > kernel_size:
+                raise ValueError(f"stride {stride} is larger than kernel_size {kernel_size}")
+            self.blend_windows(
+                video, disparity, kernel_size, stride, stitching, iters=iters, iterations=iterations
+            )
 
         else:
             stride = kernel_size // 2
-            EXTEND_VIDEO = False
+            # an odd remainder would leave a one-frame window at the end, the
+            # last frame is then repeated once through the window indices
+            num_frames = num_ims
             if (num_ims - kernel_size) % stride == 1:
-                EXTEND_VIDEO = True
-                video = torch.cat((video, video[num_ims-1:num_ims, :]), dim=0)
-                num_ims = num_ims + 1
-                print("extended video", video.shape)
-            for i in range(0, num_ims, stride):
-                left_ims = video[i : min(i + kernel_size, num_ims), 0]
-                padder = InputPadder(left_ims.shape, divis_by=32)
-
-                right_ims = video[i : min(i + kernel_size, num_ims), 1]
-                left_ims, right_ims = padder.pad(left_ims, right_ims)
-
-                with autocast(enabled=self.mixed_precision):
-                    disparities_forw = self.forward(
-                        left_ims[None].cuda(),
-                        right_ims[None].cuda(),
+                num_frames = num_ims + 1
+            starts = list(range(0, num_frames, stride))
+            first = True
+            written = 0
+            for _, disparities_forw in self.run_windows(
+                video, starts, kernel_size, iters=iters, iterations=iterations, num_frames=num_frames
+            ):
+                disparities_forw = self.trim_window(disparities_forw, kernel_size, stride, first=first)
+                first = False
+                if disparities_forw is None:
+                    continue
+                n = min(len(disparities_forw), num_ims - written)
+                # asynchronous from a GPU only if the output is pinned
+                disparity[written : written + n].copy_(
+                    disparities_forw[:n, 0, :1].abs(), non_blocking=True
+                )
+                written += n
+
+        if self.device.type == "cuda":
+            torch.cuda.current_stream(self.device).synchronize()
+
+        predictions["disparity"] = disparity
+        if iterations is not None:
+            predictions["iterations"] = iterations
+        print(predictions["disparity"].shape)
+
+        return predictions
+
+    @staticmethod
+    def allocate_output(shape, pin_memory=False, output_dir=""):
+        """
+        Zero-filled float32 tensor for the disparities of a video. With
+        `pin_memory` it is page-locked, which speeds up the copies from the GPU.
+        If `output_dir` is given it is memory-mapped from an unlinked temporary
+        file in that directory instead, so that long videos need not fit into
+        RAM. The file is freed together with the tensor.
+        """
+        if output_dir:
+            with tempfile.TemporaryFile(dir=output_dir) as f:
+                # the mapping stays valid after the file is closed
+                array = np.memmap(f, dtype=np.float32, mode="w+", shape=shape)
+            return torch.from_numpy(array)
+        return torch.zeros(shape, pin_memory=pin_memory and torch.cuda.is_available())
+
+    @staticmethod
+    def window_frames(video, start, end):
+        """video[start:end], where indices past the end repeat the last frame."""
+        if end <= len(video):
+            return video[start:end]
+        return video[torch.arange(start, end).clamp(max=len(video) - 1)]
+
+    def forward_window(self, left_ims, right_ims, iters=20, flow_cache=None, frame_offset=0, iterations=None, to_cpu=True):
+        """
+        Pad a window of frames [T, 3, H, W], run the model in test mode and return
+        the unpadded disparities [T, 1, 1, H, W], on the CPU if `to_cpu`. If
+        `iterations` is a list, the iterations run at each level are appended to it.
+        """
+        iters_used = {} if iterations is not None else None
+        padder = InputPadder(left_ims.shape, divis_by=32)
+        left_ims, right_ims = padder.pad(left_ims, right_ims)
+
+        with self.profile("window"), self.autocast():
+            disparities = self.forward(
+                left_ims[None].to(self.device),
+                right_ims[None].to(self.device),
+                iters=iters,
+                test_mode=True,
+                flow_cache=flow_cache,
+                frame_offset=frame_offset,
+                iters_used=iters_used,
+            )
+        if iterations is not None:
+            iterations.append(iters_used)
+        disparities = padder.unpad(disparities[:, 0])[:, None]
+        return disparities.cpu() if to_cpu else disparities
+
+    def run_windows(self, video, starts, kernel_size, iters=20, iterations=None, num_frames=None):
+        """
+        Yield (start, disparities) of the windows of `video` starting at the sorted
+        `starts`, in order, with the disparities left on the model device.
+        Windows end at `num_frames` (the video length if None), frames past the
+        end of the video repeat its last frame. Windows are batched by
+        forward_windows as far as max_batch_windows and the memory measured on
+        the first window of the video size allow, and RAFT flows are shared
+        between overlapping windows.
+
+        The inputs of the next batch are cut, padded and copied to the device by
+        a worker thread while the current batch runs, see prepare_windows.
+        """
+        num_ims = len(video) if num_frames is None else num_frames
+
+        def get_group(j, num_windows):
+            # only full windows are batched, a partial window runs alone
+            group = [i for i in starts[j : j + num_windows] if i + kernel_size <= num_ims]
+            return group or starts[j : j + 1]
+
+        def prepare(group):
+            length = min(kernel_size, num_ims - group[0])
+            return executor.submit(self.prepare_windows, video, group, length)
+
+        flow_cache = {}
+        # the first window of a size runs alone to measure its memory
+        window_size = (kernel_size, *video.shape[-2:])
+        measure = window_size not in self.window_memory and self.max_batch_windows > 1
+        num_windows = 1
+        if not measure:
+            num_windows = self.num_batch_windows(self.window_memory.get(window_size, 0))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            j = 0
+            group = get_group(j, num_windows)
+            future = prepare(group)
+            while group is not None:
+                prepared = future.result()
+                j += len(group)
+                next_group = None
+                if not measure and j < len(starts):
+                    next_group = get_group(j, num_windows)
+                    future = prepare(next_group)
+
+                with PeakMemory(self.device) if measure else nullcontext() as memory:
+                    outputs = self.forward_windows(
+                        prepared,
+                        group,
+                        min(kernel_size, num_ims - group[0]),
                         iters=iters,
-                        test_mode=True,
+                        flow_cache=flow_cache,
+                        iterations=iterations,
                     )
+                if measure:
+                    self.window_memory[window_size] = memory.peak
+                    num_windows = self.num_batch_windows(memory.peak)
+                    measure = False
+                    if j < len(starts):
+                        next_group = get_group(j, num_windows)
+                        future = prepare(next_group)
+
+                # pairs before the next window start are never needed again
+                next_start = starts[j] if j < len(starts) else num_ims
+                for key in [k for k in flow_cache if k[0] < next_start]:
+                    del flow_cache[key]
+
+                yield from zip(group, outputs)
+                group = next_group
+
+    @staticmethod
+    def blend_weights(length, overlap_before, overlap_after, mode="linear"):
+        """
+        Per-frame weights [length] of a window that overlaps the previous and the
+        next window by the given number of frames. The weights ramp up over the
+        leading overlap and down over the trailing one, linearly or along a
+        raised cosine, such that the ramps of two neighbouring windows sum to one.
+        """
+        t = torch.arange(length, dtype=torch.float)
+        ramp_in = (t + 1) / (overlap_before + 1)
+        ramp_out = (length - t) / (overlap_after + 1)
+        weights = torch.minimum(ramp_in, ramp_out).clamp(max=1)
+        if mode == "cosine":
+            weights = 0.5 - 0.5 * torch.cos(torch.pi * weights)
+        return weights
+
+    def blend_windows(self, video, disparity, kernel_size, stride, mode, iters=20, iterations=None):
+        """
+        Run full windows advancing by `stride` frames over `video`, the last one
+        aligned to the end of the video, and accumulate the weighted average of the
+        absolute disparities predicted for every frame into the zero-filled
+        `disparity` [T, 1, H, W].
+        """
+        num_ims = len(video)
+        starts = list(range(0, num_ims - kernel_size, stride)) + [num_ims - kernel_size]
+        weight_sum = torch.zeros(num_ims)
+        for w, (start, disparities) in enumerate(
+            self.run_windows(video, starts, kernel_size, iters=iters, iterations=iterations)
+        ):
+            overlap_before = starts[w - 1] + kernel_size - start if w > 0 else 0
+            overlap_after = start + kernel_size - starts[w + 1] if w + 1 < len(starts) else 0
+            weights = self.blend_weights(kernel_size, overlap_before, overlap_after, mode)
+            end = start + kernel_size
+            # blocks until the window is done, the weights are added on the CPU
+            disparities = disparities[:, 0, :1].abs().cpu()
+            disparity[start:end].addcmul_(weights[:, None, None, None], disparities)
+            weight_sum[start:end] += weights
+        disparity /= weight_sum[:, None, None, None]
+
+    def num_batch_windows(self, window_memory):
+        """Windows per forward call that fit into the free memory, at most max_batch_windows."""
+        available = available_memory(self.device)
+        if available is None or window_memory <= 0:
+            return self.max_batch_windows
+        # keep some headroom for the allocator and the stitched outputs
+        return max(1, min(self.max_batch_windows, int(0.9 * available / window_memory)))
+
+    def prepare_windows(self, video, starts, kernel_size):
+        """
+        Cut the frames spanned by the windows of `kernel_size` frames starting at
+        `starts` out of `video` [T, 2, 3, H, W], repeating its last frame past the
+        end, pad them and move them to the model device. On a GPU the copies are
+        issued from page-locked memory on a side stream, so that they overlap the
+        computation of the previous windows. Returns (padder, left, right, event),
+        forward_windows waits for the CUDA event before using the frames.
+        """
+        span = self.window_frames(video, starts[0], starts[-1] + kernel_size)
+        padder = InputPadder(span.shape, divis_by=32)
+        left_ims, right_ims = padder.pad(span[:, 0], span[:, 1])
+        if self.device.type != "cuda":
+            return padder, left_ims.to(self.device), right_ims.to(self.device), None
+
+        if self.copy_stream is None:
+            self.copy_stream = torch.cuda.Stream(self.device)
+        with torch.cuda.stream(self.copy_stream):
+            left_ims = left_ims.pin_memory().to(self.device, non_blocking=True)
+            right_ims = right_ims.pin_memory().to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.copy_stream)
+        return padder, left_ims, right_ims, event
+
+    def forward_windows(self, prepared, starts, kernel_size, iters=20, flow_cache=None, iterations=None):
+        """
+        Run the windows of `kernel_size` frames that start at `starts`, given the
+        output of prepare_windows, and return their unpadded disparities as
+        forward_window does, left on the model device. Several windows are
+        stacked along the batch dimension of a single forward call. The RAFT
+        flows of the frames they span are computed once, so that overlapping
+        windows share them as well. The windows of a batch stop early together
+        and report the same iterations.
+        """
+        padder, left_ims, right_ims, event = prepared
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # the frames were allocated on the copy stream
+            left_ims.record_stream(stream)
+            right_ims.record_stream(stream)
+
+        first = starts[0]
+        iters_used = {} if iterations is not None else None
+        with self.profile("window"), self.autocast():
+            with self.profile("compute_flow"):
+                flows_forward, flows_backward = self.compute_flow(
+                    right_ims[None], flow_cache=flow_cache, frame_offset=first
+                )
+            flows_forward = torch.stack(flows_forward, dim=1)
+            flows_backward = torch.stack(flows_backward, dim=1)
 
-                disparities_forw = padder.unpad(disparities_forw[:, 0])[:, None].cpu()
-
-                if len(disp_preds) > 0 and len(disparities_forw) >= stride:
-
-                    if len(disparities_forw) < kernel_size:
-                        disp_preds.append(disparities_forw[stride // 2 :])
-                    else:
-                        disp_preds.append(disparities_forw[stride // 2 : -stride // 2])
-
-                elif len(disp_preds) == 0:
-                    disp_preds.append(disparities_forw[: -stride // 2])
-
-            predictions["disparity"] = (torch.cat(disp_preds).squeeze(1).abs())[:, :1]
-            if EXTEND_VIDEO:
-                predictions["disparity"] = predictions["disparity"][:num_ims-1,:,:,:]
-            print(predictions["disparity"].shape)
-
-            return predictions
-
-    def compute_flow(self, seq):
+            if len(starts) == 1:
+                left_windows, right_windows = left_ims[None], right_ims[None]
+            else:
+                offsets = [i - first for i in starts]
+                left_windows = torch.stack([left_ims[o : o + kernel_size] for o in offsets])
+                right_windows = torch.stack([right_ims[o : o + kernel_size] for o in offsets])
+                flows_forward = torch.cat([flows_forward[:, o : o + kernel_size - 1] for o in offsets])
+                flows_backward = torch.cat([flows_backward[:, o : o + kernel_size - 1] for o in offsets])
+            disparities = self.forward(
+                left_windows,
+                right_windows,
+                iters=iters,
+                test_mode=True,
+                flows=(flows_forward, flows_backward),
+                iters_used=iters_used,
+            )
+        if iterations is not None:
+            iterations.extend(dict(iters_used) for _ in starts)
+        return [padder.unpad(disparities[:, w])[:, None] for w in range(len(starts))]
+
+    @staticmethod
+    def trim_window(disparities, kernel_size, stride, first=False):
+        """
+        Keep the frames of a sliding window that end up in the stitched video:
+        the first window drops its trailing `stride // 2` frames, the following
+        windows drop `stride // 2` frames on both sides, and a trailing partial
+        window keeps everything after its leading overlap. Returns None if the
+        window contributes no frames.
+        """
+        if first:
+            return disparities[: -stride // 2]
+        if len(disparities) < stride:
+            return None
+        if len(disparities) < kernel_size:
+            return disparities[stride // 2 :]
+        return disparities[stride // 2 : -stride // 2]
+
+    def compute_flow(self, seq, flow_cache=None, frame_offset=0):
+        """
+        Compute forward and backward RAFT flows between adjacent frames.
+
+        Both directions of all adjacent pairs are stacked into the batch of a
+        single RAFT call, split into chunks of at most `raft_batch_size` image
+        pairs. If `flow_cache` is given, flows are looked up by the global
+        frame index pair `(frame_offset + i, frame_offset + i + 1)` and only
+        missing pairs are passed through RAFT. Newly computed flows are stored
+        in the cache.
+        """
         n, t, c, h, w = seq.size()
-        flows_forward = []
-        flows_backward = []
+        flows = {}
+        missing = []
         for i in range(t-1):
-            # i-th flow_backward denotes seq[i+1] towards seq[i]
-            flow_backward = self.raft(seq[:,i], seq[:,i+1])
+            key = (frame_offset + i, frame_offset + i + 1)
+            if flow_cache is not None and key in flow_cache:
+                flows[i] = flow_cache[key]
+            else:
+                missing.append(i)
+
+        if len(missing) > 0:
+            prev_ims = seq[:, missing]
+            next_ims = seq[:, [i + 1 for i in missing]]
+            # i-th flow_backward denotes seq[i+1] towards seq[i],
             # i-th flow_forward denotes seq[i] towards seq[i+1]
-            flow_forward = self.raft(seq[:,i+1], seq[:,i])
-            flows_backward.append(flow_backward)
-            flows_forward.append(flow_forward)
+            image1 = rearrange(torch.cat([prev_ims, next_ims], dim=1), "b t c h w -> (t b) c h w")
+            image2 = rearrange(torch.cat([next_ims, prev_ims], dim=1), "b t c h w -> (t b) c h w")
+
+            chunk = self.raft_batch_size if self.raft_batch_size > 0 else len(image1)
+            # the flows align features over several frames, they stay in fp32
+            with self.autocast(enabled=False):
+                raft_flows = torch.cat(
+                    [
+                        self.raft(image1[j : j + chunk], image2[j : j + chunk])
+                        for j in range(0, len(image1), chunk)
+                    ]
+                )
+            raft_flows = rearrange(raft_flows, "(t b) c h w -> t b c h w", b=n)
+
+            for k, i in enumerate(missing):
+                flow_forward = raft_flows[len(missing) + k]
+                flow_backward = raft_flows[k]
+                flows[i] = (flow_forward, flow_backward)
+                if flow_cache is not None:
+                    flow_cache[(frame_offset + i, frame_offset + i + 1)] = flows[i]
+
+        flows_forward = [flows[i][0] for i in range(t-1)]
+        flows_backward = [flows[i][1] for i in range(t-1)]
 
         return flows_forward, flows_backward
 
     def flow_warp(self, x, flow):
-        if flow.size(3) != 2:  # [B, H, W, 2]
-            flow = flow.permute(0, 2, 3, 1)
-        if x.size()[-2:] != flow.size()[1:3]:
-            raise ValueError(f'The spatial sizes of input ({x.size()[-2:]}) and '
-                             f'flow ({flow.size()[1:3]}) are not the same.')
-        _, _, h, w = x.size()
-        # create mesh grid
-        grid_y, grid_x = torch.meshgrid(torch.arange(0, h), torch.arange(0, w))
-        grid = torch.stack((grid_x, grid_y), 2).type_as(x)  # (h, w, 2)
-        grid.requires_grad = False
-
-        grid_flow = grid + flow
-        # scale grid_flow to [-1,1]
-        grid_flow_x = 2.0 * grid_flow[:, :, :, 0] / max(w - 1, 1) - 1.0
-        grid_flow_y = 2.0 * grid_flow[:, :, :, 1] / max(h - 1, 1) - 1.0
-        grid_flow = torch.stack((grid_flow_x, grid_flow_y), dim=3)
-        output = F.grid_sample(
-            x,
-            grid_flow,
-            mode='bilinear',
-            padding_mode='zeros',
-            align_corners=True)
-        return output
-
-    def forward(self, seq1, seq2, flow_init=None, iters=10, test_mode=False):
+        # also warps the motion hidden states of the update block
+        with self.profile("feature_warp"):
+            return flow_warp(x, flow)
+
+    def forward(self, seq1, seq2, flow_init=None, iters=10, test_mode=False, flow_cache=None, frame_offset=0, flows=None, iters_used=None):
+        """
+        `flows` optionally holds precomputed (forward, backward) RAFT flows of
+        `seq2`, each of shape [B, T-1, 2, H/4, W/4], in which case RAFT is skipped.
+        If `iters_used` is a dict, the iterations run at the 16, 8 and 4 levels
+        are stored in it.
+        """
         b, T, *_ = seq1.shape
 
+        early_exit = test_mode and self.early_exit_threshold > 0
+        max_iters = (iters//2, iters//2, iters)
+        if early_exit and len(self.early_exit_max_iters) > 0:
+            max_iters = self.early_exit_max_iters
+        min_iters = self.early_exit_min_iters
+        if iters_used is None:
+            iters_used = {}
+
         # compute optical flow
-        flows_forward2, flows_backward2 = self.compute_flow(seq2)
+        if flows is None:
+            with self.profile("compute_flow"):
+                flows_forward2, flows_backward2 = self.compute_flow(seq2, flow_cache=flow_cache, frame_offset=frame_offset)
 
-        flow_forward2 = torch.stack(flows_forward2, dim=1)
-        flow_backward2 = torch.stack(flows_backward2, dim=1)
+            flow_forward2 = torch.stack(flows_forward2, dim=1)
+            flow_backward2 = torch.stack(flows_backward2, dim=1)
+        else:
+            flow_forward2, flow_backward2 = flows
         flow_forward2 = rearrange(flow_forward2, "b t c h w -> (b t) c h w")
         flow_backward2 = rearrange(flow_backward2, "b t c h w -> (b t) c h w")
         s_flow_forward2 = 1 / 2 * F.interpolate(flow_forward2,
@@ -213,7 +616,7 @@ class BiDAStereo(nn.Module):
         cdim = self.context_dim
 
         # feature network
-        with autocast(enabled=self.mixed_precision):
+        with self.profile("fnet"), self.autocast():
             seqmap1, seqmap2 = self.fnet([seq1, seq2])  # 256 * H/4 * W/4
 
         seqmap2 = rearrange(seqmap2, "(b t) c h w -> b t c h w", b=b, t=T)
@@ -229,11 +632,14 @@ class BiDAStereo(nn.Module):
         feat_prop2_forward = rearrange(feat_prop2_forward, "(b t) c h w -> b t c h w", b=b, t=T-1)
         output2_forward = torch.cat((seqmap2[:, :1], feat_prop2_forward), dim=1)
 
-        fmap1 = seqmap1
-        fmap2 = torch.cat((seqmap2, output2_forward, output2_backward), dim=1)
-        fmap2 = rearrange(fmap2, "b t c h w -> (b t) c h w")
+        # the correlation is computed in fp32
+        fmap1 = seqmap1.float()
+        # TFCL splits fmap2 into its three groups along the batch, so the groups
+        # come first and the windows of a batch stay apart within each group
+        fmap2 = torch.stack((seqmap2, output2_forward, output2_backward))
+        fmap2 = rearrange(fmap2, "g b t c h w -> (g b t) c h w")
 
-        with autocast(enabled=self.mixed_precision):
+        with self.autocast():
             # 1/4 -> 1/8
             # feature
             s_fmap1 = F.avg_pool2d(fmap1, 2, stride=2)
@@ -256,9 +662,10 @@ class BiDAStereo(nn.Module):
             ss_inp = F.avg_pool2d(inp, 4, stride=4)
 
         # Triple Frame Correlation Layer
-        corr_fn = TFCL(fmap1, fmap2)
-        s_corr_fn = TFCL(s_fmap1, s_fmap2)
-        ss_corr_fn = TFCL(ss_fmap1, ss_fmap2)
+        with self.profile("tfcl"), self.autocast(enabled=False):
+            corr_fn = self.build_corr_fn(fmap1, fmap2, level=4)
+            s_corr_fn = self.build_corr_fn(s_fmap1, s_fmap2, level=8)
+            ss_corr_fn = self.build_corr_fn(ss_fmap1, ss_fmap2, level=16)
 
         # cascaded refinement (1/16 + 1/8 + 1/4)
         flow_predictions = []
@@ -274,22 +681,34 @@ class BiDAStereo(nn.Module):
             ss_motion_hidden_state = None
 
             # 1/16
-            for itr in range(iters//2):
+            for itr in range(max_iters[0]):
                 if itr % 2 == 0:
                     small_patch = False
                 else:
                     small_patch = True
 
                 ss_flow = ss_flow.detach()
-                out_corrs = ss_corr_fn(ss_flow, None, small_patch=small_patch)
+                # the disparity is purely horizontal
+                ss_flow[:, 1:] = 0
+                with self.profile("tfcl"), self.autocast(enabled=False):
+                    out_corrs = ss_corr_fn(ss_flow, None, small_patch=small_patch)
 
-                with autocast(enabled=self.mixed_precision):
-                    ss_net, up_mask, delta_flow, ss_motion_hidden_state = self.update_block(ss_net, ss_inp, out_corrs, ss_flow, ss_motion_hidden_state, ss_flow_forward2, ss_flow_backward2, t=T)
+                with self.profile("update_block"), self.autocast():
+                    ss_net, up_mask, delta_flow, ss_motion_hidden_state = self.update_block(ss_net, ss_inp, out_corrs, ss_flow, ss_motion_hidden_state, ss_flow_forward2, ss_flow_backward2, t=T, warp=self.flow_warp)
 
                 ss_flow = ss_flow + delta_flow
-                flow = self.convex_upsample(ss_flow, up_mask, rate=4)
-                flow_up = 4 * F.interpolate(flow, size=(4 * flow.shape[2], 4 * flow.shape[3]), mode='bilinear', align_corners=True)
-                flow_predictions.append(flow_up[:, :1])
+                last = itr == max_iters[0] - 1 or (
+                    early_exit and itr + 1 >= min_iters[0] and self.has_converged(delta_flow, 16)
+                )
+                # at inference only the last iteration is upsampled, to initialize the 1/8 level
+                if not test_mode or last:
+                    flow = self.convex_upsample(ss_flow, up_mask, rate=4)
+                if not test_mode:
+                    flow_up = 4 * F.interpolate(flow, size=(4 * flow.shape[2], 4 * flow.shape[3]), mode='bilinear', align_corners=True)
+                    flow_predictions.append(flow_up[:, :1])
+                iters_used[16] = itr + 1
+                if last:
+                    break
 
             scale = s_fmap1.shape[2] / flow.shape[2]
             s_flow = scale * interp(flow, size=(s_fmap1.shape[2], s_fmap1.shape[3]))
@@ -297,22 +716,33 @@ class BiDAStereo(nn.Module):
                                         align_corners=True)
 
             # 1/8
-            for itr in range(iters//2):
+            for itr in range(max_iters[1]):
                 if itr % 2 == 0:
                     small_patch = False
                 else:
                     small_patch = True
 
                 s_flow = s_flow.detach()
-                out_corrs = s_corr_fn(s_flow, None, small_patch=small_patch)
+                # the disparity is purely horizontal
+                s_flow[:, 1:] = 0
+                with self.profile("tfcl"), self.autocast(enabled=False):
+                    out_corrs = s_corr_fn(s_flow, None, small_patch=small_patch)
 
-                with autocast(enabled=self.mixed_precision):
-                    s_net, up_mask, delta_flow, s_motion_hidden_state = self.update_block(s_net, s_inp, out_corrs, s_flow, s_motion_hidden_state, s_flow_forward2, s_flow_backward2, t=T)
+                with self.profile("update_block"), self.autocast():
+                    s_net, up_mask, delta_flow, s_motion_hidden_state = self.update_block(s_net, s_inp, out_corrs, s_flow, s_motion_hidden_state, s_flow_forward2, s_flow_backward2, t=T, warp=self.flow_warp)
 
                 s_flow = s_flow + delta_flow
-                flow = self.convex_upsample(s_flow, up_mask, rate=4)
-                flow_up = 2 * F.interpolate(flow, size=(2 * flow.shape[2], 2 * flow.shape[3]), mode='bilinear', align_corners=True)
-                flow_predictions.append(flow_up[:, :1])
+                last = itr == max_iters[1] - 1 or (
+                    early_exit and itr + 1 >= min_iters[1] and self.has_converged(delta_flow, 8)
+                )
+                if not test_mode or last:
+                    flow = self.convex_upsample(s_flow, up_mask, rate=4)
+                if not test_mode:
+                    flow_up = 2 * F.interpolate(flow, size=(2 * flow.shape[2], 2 * flow.shape[3]), mode='bilinear', align_corners=True)
+                    flow_predictions.append(flow_up[:, :1])
+                iters_used[8] = itr + 1
+                if last:
+                    break
 
             scale = fmap1.shape[2] / flow.shape[2]
             flow = scale * interp(flow, size=(fmap1.shape[2], fmap1.shape[3]))
@@ -320,27 +750,151 @@ class BiDAStereo(nn.Module):
         motion_hidden_state = F.interpolate(s_motion_hidden_state, size=(2 * s_motion_hidden_state.shape[2],
                                                                          2 * s_motion_hidden_state.shape[3]), mode='bilinear',align_corners=True)  # 2 * H/2 * W/2
         # 1/4
-        for itr in range(iters):
+        for itr in range(max_iters[2]):
             if itr % 2 == 0:
                 small_patch = False
             else:
                 small_patch = True
 
             flow = flow.detach()
-            out_corrs = corr_fn(flow, None, small_patch=small_patch)
+            # the disparity is purely horizontal
+            flow[:, 1:] = 0
+            with self.profile("tfcl"), self.autocast(enabled=False):
+                out_corrs = corr_fn(flow, None, small_patch=small_patch)
 
-            with autocast(enabled=self.mixed_precision):
-                net, up_mask, delta_flow, motion_hidden_state = self.update_block(net, inp, out_corrs, flow, motion_hidden_state, flow_forward2, flow_backward2, t=T)
+            with self.profile("update_block"), self.autocast():
+                net, up_mask, delta_flow, motion_hidden_state = self.update_block(net, inp, out_corrs, flow, motion_hidden_state, flow_forward2, flow_backward2, t=T, warp=self.flow_warp)
 
             flow = flow + delta_flow
-            flow_up = self.convex_upsample(flow, up_mask, rate=4)
-            flow_predictions.append(flow_up[:, :1])
+            last = itr == max_iters[2] - 1 or (
+                early_exit and itr + 1 >= min_iters[2] and self.has_converged(delta_flow, 4)
+            )
+            if not test_mode or last:
+                flow_up = self.convex_upsample(flow, up_mask, rate=4)
+                flow_predictions.append(flow_up[:, :1])
+            iters_used[4] = itr + 1
+            if last:
+                break
+
+        if test_mode:
+            # only the full resolution output of the last iteration is kept
+            return rearrange(flow_predictions[-1], "(b t) c h w -> t b c h w", b=b, t=T)
 
         predictions = torch.stack(flow_predictions)
         predictions = rearrange(predictions, "d (b t) c h w -> d t b c h w", b=b, t=T)
-        flow_up = predictions[-1]
 
-        if test_mode:
-            return flow_up
+        return predictions
+
+class BiDAStereoStream:
+    """
+    Online inference over an unbounded stereo stream.
 
-        return predictions
\ No newline at end of file
+    Frames are pushed one pair at a time into a rolling buffer of `kernel_size`
+    frames. Whenever the buffer is full the window is run, the frames that
+    `forward_batch_test` keeps from it are returned and the buffer advances by
+    `kernel_size // 2` frames. `flush` runs the windows left at the end of the
+    stream. The concatenation of all outputs matches `forward_batch_test` on
+    the whole video.
+    """
+
+    def __init__(
+        self, model: BiDAStereo, kernel_size: int = 14, iters: int = 20, max_iterations: int = 100
+    ):
+        self.model = model
+        self.kernel_size = kernel_size
+        self.stride = kernel_size // 2
+        self.iters = iters
+        # refinement iterations run at each level by the last `max_iterations`
+        # windows when exiting early, None otherwise
+        self.iterations = None
+        if model.early_exit_threshold > 0:
+            self.iterations = deque(maxlen=max_iterations)
+        # [H, W] of the pushed frames, for the shape of empty outputs
+        self.frame_size = (0, 0)
+        self.reset()
+
+    def reset(self):
+        # buffered (left, right) frames, the first one has index self.start
+        self.frames = []
+        self.start = 0
+        self.num_frames = 0
+        self.num_emitted = 0
+        self.flow_cache = {}
+        # kept in case the stream ends up being exactly one window long
+        self.last_window = None
+
+    @torch.no_grad()
+    def push(self, left, right):
+        """
+        Add a stereo pair [3, H, W] and return the disparities [N, 1, H, W] of
+        the frames that became final, N may be 0.
+        """
+        self.frames.append((left, right))
+        self.frame_size = left.shape[-2:]
+        self.num_frames += 1
+        if len(self.frames) < self.kernel_size:
+            return self._emit([])
+        return self._emit([self._run_window()])
+
+    @torch.no_grad()
+    def flush(self):
+        """
+        Finish the stream and return the disparities [N, 1, H, W] of all frames
+        that have not been emitted yet, N is 0 if there are none. The stream is
+        reset afterwards.
+        """
+        if self.num_frames == 0:
+            return self._emit([])
+
+        if self.num_frames <= self.kernel_size:
+            # forward_batch_test runs a video this short as a single window
+            if self.last_window is None:
+                self.last_window = self.model.forward_window(
+                    torch.stack([left for left, _ in self.frames]),
+                    torch.stack([right for _, right in self.frames]),
+                    iters=self.iters,
+                    iterations=self.iterations,
+                )
+            outputs = [self.last_window[self.num_emitted:]]
+        else:
+            num_ims = self.num_frames
+            if (num_ims - self.kernel_size) % self.stride == 1:
+                self.frames.append(self.frames[-1])
+                num_ims = num_ims + 1
+            outputs = []
+            while self.start < num_ims:
+                outputs.append(self._run_window())
+
+        num_remaining = self.num_frames - self.num_emitted
+        disparities = self._emit(outputs)[:num_remaining]
+        self.reset()
+        return disparities
+
+    def _run_window(self):
+        window = self.frames[: self.kernel_size]
+        disparities = self.model.forward_window(
+            torch.stack([left for left, _ in window]),
+            torch.stack([right for _, right in window]),
+            iters=self.iters,
+            flow_cache=self.flow_cache,
+            frame_offset=self.start,
+            iterations=self.iterations,
+        )
+        for key in [k for k in self.flow_cache if k[0] < self.start + self.stride]:
+            del self.flow_cache[key]
+
+        self.last_window = disparities
+        disparities = BiDAStereo.trim_window(
+            disparities, self.kernel_size, self.stride, first=self.start == 0
+        )
+        self.frames = self.frames[self.stride :]
+        self.start += self.stride
+        return disparities
+
+    def _emit(self, outputs):
+        outputs = [disp for disp in outputs if disp is not None]
+        if len(outputs) == 0:
+            return torch.zeros(0, 1, *self.frame_size)
+        disparities = (torch.cat(outputs).squeeze(1).abs())[:, :1]
+        self.num_emitted += len(disparities)
+        return disparities
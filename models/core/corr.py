@@ -33,10 +33,41 @@ def coords_grid(batch, ht, wd, device):
     coords = torch.stack(coords[::-1], dim=0).float()
     return coords[None].repeat(batch, 1, 1, 1)
 
+def horizontal_sampler(img, xgrid):
+    """
+    Linear interpolation along x only, uses pixel coordinates.
+
+    Samples img [G * N, C, H, W] at the columns xgrid [N, 1, H, W] of each row,
+    the same columns are used for each of the G groups of N images. This equals
+    bilinear_sampler with integer row coordinates and zero padding.
+    """
+    B, C, H, W = img.shape
+    N = xgrid.shape[0]
+    x0 = torch.floor(xgrid)
+    alpha = xgrid - x0
+    x0 = x0.long()
+    x1 = x0 + 1
+
+    # taps outside the image contribute zeros
+    w0 = (1 - alpha) * ((x0 >= 0) & (x0 <= W - 1))
+    w1 = alpha * ((x1 >= 0) & (x1 <= W - 1))
+    x0 = x0.clamp(0, W - 1).expand(N, C, H, W)
+    x1 = x1.clamp(0, W - 1).expand(N, C, H, W)
+
+    img = img.view(B // N, N, C, H, W)
+    img = w0 * img.gather(4, x0.expand_as(img)) + w1 * img.gather(4, x1.expand_as(img))
+    return img.view(B, C, H, W)
+
+
 class TFCL:
     """
     Implementation of Triple-frame Correlation Layer (TFCL).
     """
+
+    # upper bound on the number of elements of the temporary product built by
+    # batched_correlation, larger batches are correlated in chunks of frames
+    max_corr_elements = 2 ** 28
+
     def __init__(self, fmap1, fmap2):
         self.fmap1 = fmap1
         self.fmap2 = fmap2
@@ -49,11 +80,15 @@ class TFCL:
         return corr
 
     def correlation(self, left_feature, right_feature, flow, small_patch):
-        flow[:, 1:] = 0
-        coords = self.coords + flow
-        coords = coords.permute(0, 2, 3, 1)
-        coords = coords.repeat(3,1,1,1)
-        right_feature = bilinear_sampler(right_feature, coords)
+        # the lookup is a horizontal shift of the frame, forward-warped and
+        # backward-warped right features, the vertical flow is ignored
+        xgrid = self.coords[:, :1] + flow[:, :1]
+        if right_feature.is_cuda:
+            right_feature = horizontal_sampler(right_feature, xgrid)
+        else:
+            # grid_sample is faster than the gathers of horizontal_sampler on the CPU
+            coords = torch.cat([xgrid, self.coords[:, 1:]], dim=1).permute(0, 2, 3, 1)
+            right_feature = bilinear_sampler(right_feature, coords.repeat(3, 1, 1, 1))
 
         if small_patch:
             psize_list = [(3, 3), (3, 3), (3, 3), (3, 3)]
@@ -82,6 +117,11 @@ class TFCL:
 
         right_pad = F.pad(right_feature, [padx, padx, pady, pady], mode='replicate')
 
+        if left_feature.is_cuda:
+            return self.batched_correlation(left_feature, right_pad, dilate)
+
+        # on the CPU the per-offset loop is memory bound and faster than the
+        # batched product, which is 9 times larger than a single crop product
         corr_list = []
         for h in range(0, pady * 2 + 1, di_y):
             for w in range(0, padx * 2 + 1, di_x):
@@ -92,4 +132,108 @@ class TFCL:
 
         corr_final = torch.cat(corr_list, dim=1)
 
-        return corr_final
\ No newline at end of file
+        return corr_final
+
+    def batched_correlation(self, left_feature, right_pad, dilate=(1, 1)):
+        """
+        Correlate `left_feature` with all crops of the padded right features in
+        one batched product instead of one product per offset.
+        """
+        N, C, H, W = left_feature.size()
+        di_y, di_x = dilate[0], dilate[1]
+        pady, padx = (right_pad.shape[2] - H) // 2, (right_pad.shape[3] - W) // 2
+
+        # [N, C, H, W, psize_y, psize_x] view of all shifted crops, nothing is copied
+        right_crops = right_pad.unfold(2, pady * 2 + 1, 1).unfold(3, padx * 2 + 1, 1)
+        right_crops = right_crops[..., ::di_y, ::di_x]
+
+        # the product is materialized, so bound its size by splitting the batch
+        chunk = max(1, self.max_corr_elements // right_crops[0].numel())
+        corr_list = []
+        for i in range(0, N, chunk):
+            corr = (left_feature[i:i + chunk, ..., None, None] * right_crops[i:i + chunk]).mean(dim=1)
+            corr_list.append(corr)
+
+        corr_final = corr_list[0] if len(corr_list) == 1 else torch.cat(corr_list, dim=0)
+        # offsets are ordered row-major, as in the per-offset loop
+        corr_final = corr_final.reshape(N, H, W, -1).permute(0, 3, 1, 2)
+
+        return corr_final
+
+
+class TFCLVolume(TFCL):
+    """
+    TFCL backed by all-pairs horizontal correlation volumes, in the spirit of
+    CorrBlock1D in RAFT-Stereo.
+
+    The correlation of every left pixel with every right pixel of the same row
+    (and of the rows above and below for the 3x3 patches) is computed once. A
+    lookup then only interpolates the volumes at the flow-shifted columns,
+    which is cheap on coarse levels that are refined for many iterations.
+    """
+
+    def __init__(self, fmap1, fmap2):
+        super().__init__(fmap1, fmap2)
+        N, C, H, W = fmap1.shape
+        left_feature = fmap1.to(fmap2.dtype)
+        right_pad = F.pad(fmap2, [0, 0, 1, 1], mode='replicate')
+        right_pad = right_pad.view(3, N, C, H + 2, W)
+
+        # volumes[dy][g, n, h, w, x] = <left[n, :, h, w], right_g[n, :, h + dy, x]> / C
+        self.volumes = {}
+        for dy in (-1, 0, 1):
+            right_rows = right_pad[:, :, :, 1 + dy:1 + dy + H]
+            self.volumes[dy] = torch.einsum('nchw,gnchx->gnhwx', left_feature, right_rows) / C
+
+    @staticmethod
+    def volume_numel(fmap1):
+        N, _, H, W = fmap1.shape
+        return 3 * 3 * N * H * W * W
+
+    def correlation(self, left_feature, right_feature, flow, small_patch):
+        N, _, H, W = flow.shape
+        pady, padx = (1, 1) if small_patch else (0, 4)
+
+        # the column every offset of the patch is sampled at, with the same
+        # replicate padding get_correlation applies to the sampled features
+        xgrid = self.coords[:, :1] + flow[:, :1]
+        xgrid = F.pad(xgrid, [padx, padx, pady, pady], mode='replicate')[:, 0]
+
+        corrs = []
+        for dy in range(-pady, pady + 1):
+            x = xgrid[:, pady + dy:pady + dy + H].unfold(2, padx * 2 + 1, 1)
+            corrs.append(self.volume_sampler(self.volumes[dy], x))
+
+        # [3, N, H, W, psize] -> [N, 3 * psize, H, W], grouped as in TFCL
+        final_corr = torch.cat(corrs, dim=-1).permute(1, 0, 4, 2, 3)
+        final_corr = final_corr.reshape(N, -1, H, W)
+
+        return final_corr
+
+    @staticmethod
+    def volume_sampler(volume, x):
+        """Linearly interpolate volume [G, N, H, W, W] along its last dim at x [N, H, W, K]."""
+        W = volume.shape[-1]
+        x0 = torch.floor(x)
+        alpha = x - x0
+        x0 = x0.long()
+        x1 = x0 + 1
+
+        # columns outside the image contribute zeros, as in bilinear_sampler
+        w0 = (1 - alpha) * ((x0 >= 0) & (x0 <= W - 1))
+        w1 = alpha * ((x1 >= 0) & (x1 <= W - 1))
+        x0 = x0.clamp(0, W - 1).expand(volume.shape[0], *x.shape)
+        x1 = x1.clamp(0, W - 1).expand(volume.shape[0], *x.shape)
+
+        return w0 * volume.gather(4, x0) + w1 * volume.gather(4, x1)
+
+
+def build_tfcl(fmap1, fmap2, volume=False, max_volume_elements=2 ** 28):
+    """
+    Create the correlation layer of one pyramid level. The precomputed volume
+    backend is used when requested and when its volumes fit into
+    `max_volume_elements`, otherwise the on-the-fly TFCL is used.
+    """
+    if volume and TFCLVolume.volume_numel(fmap1) <= max_volume_elements:
+        return TFCLVolume(fmap1, fmap2)
+    return TFCL(fmap1, fmap2)
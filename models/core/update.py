@@ -9,6 +9,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from bidastereo.models.core.utils.utils import flow_warp
+
 
 class FlowHead3D(nn.Module):
     def __init__(self, input_dim=128, hidden_dim=256):
@@ -99,31 +101,11 @@ class MultiMotionEncoder(nn.Module):
                   interpolation='bilinear',
                   padding_mode='zeros',
                   align_corners=True):
-        if flow.size(3) != 2:  # [B, H, W, 2]
-            flow = flow.permute(0, 2, 3, 1)
-        if x.size()[-2:] != flow.size()[1:3]:
-            raise ValueError(f'The spatial sizes of input ({x.size()[-2:]}) and '
-                             f'flow ({flow.size()[1:3]}) are not the same.')
-        _, _, h, w = x.size()
-        # create mesh grid
-        grid_y, grid_x = torch.meshgrid(torch.arange(0, h), torch.arange(0, w))
-        grid = torch.stack((grid_x, grid_y), 2).type_as(x)  # (h, w, 2)
-        grid.requires_grad = False
-
-        grid_flow = grid + flow
-        # scale grid_flow to [-1,1]
-        grid_flow_x = 2.0 * grid_flow[:, :, :, 0] / max(w - 1, 1) - 1.0
-        grid_flow_y = 2.0 * grid_flow[:, :, :, 1] / max(h - 1, 1) - 1.0
-        grid_flow = torch.stack((grid_flow_x, grid_flow_y), dim=3)
-        output = F.grid_sample(
-            x,
-            grid_flow,
-            mode=interpolation,
-            padding_mode=padding_mode,
-            align_corners=align_corners)
-        return output
-
-    def forward(self, motion_hidden_state, flow_forward, flow_backward, flow, corr, t):
+        return flow_warp(x, flow, interpolation, padding_mode, align_corners)
+
+    def forward(self, motion_hidden_state, flow_forward, flow_backward, flow, corr, t, warp=None):
+        # warp replaces self.flow_warp, BiDAStereo passes its profiled warp
+        warp = warp or self.flow_warp
 
         BN, _, H, W = flow.shape
         bs = BN // t
@@ -133,12 +115,12 @@ class MultiMotionEncoder(nn.Module):
             motion_hidden_state = motion_hidden_state.reshape(bs, t, -1, H, W)
 
         backward_motion_hidden_state = rearrange(motion_hidden_state[:, 1:, ...], "b t c h w -> (b t) c h w")
-        backward_motion_hidden_state = self.flow_warp(backward_motion_hidden_state, flow_backward)
+        backward_motion_hidden_state = warp(backward_motion_hidden_state, flow_backward)
         backward_motion_hidden_state = rearrange(backward_motion_hidden_state, "(b t) c h w -> b t c h w", b=bs, t=t-1)
         backward_motion_hidden_state = torch.cat((backward_motion_hidden_state,motion_hidden_state[:, -1:, ...]), dim = 1)
 
         forward_motion_hidden_state = rearrange(motion_hidden_state[:, :t-1, ...], "b t c h w -> (b t) c h w")
-        forward_motion_hidden_state = self.flow_warp(forward_motion_hidden_state, flow_forward)
+        forward_motion_hidden_state = warp(forward_motion_hidden_state, flow_forward)
         forward_motion_hidden_state = rearrange(forward_motion_hidden_state, "(b t) c h w -> b t c h w", b=bs, t=t-1)
         forward_motion_hidden_state = torch.cat((motion_hidden_state[:, :1, ...], forward_motion_hidden_state), dim=1)
 
@@ -170,8 +152,8 @@ class MultiSequenceUpdateBlock3D(nn.Module):
             nn.Conv2d(hidden_dim + 128, (mask_size ** 2) * 9, 1, padding=0),
         )
 
-    def forward(self, net, inp, corrs, flows, motion_hidden_state, flow_forward, flow_backward, t):
-        motion_features, motion_hidden_state = self.encoder(motion_hidden_state, flow_forward, flow_backward, flows, corrs, t=t)
+    def forward(self, net, inp, corrs, flows, motion_hidden_state, flow_forward, flow_backward, t, warp=None):
+        motion_features, motion_hidden_state = self.encoder(motion_hidden_state, flow_forward, flow_backward, flows, corrs, t=t, warp=warp)
         inp_tensor = torch.cat([inp, motion_features], dim=1)
 
         net = rearrange(net, "(b t) c h w -> b c t h w", t=t)
@@ -0,0 +1,181 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+# returned by BiDAStereo.profile when profiling is disabled
+NO_PROFILING = nullcontext()
+
+
+def read_proc_kb(path, field):
+    """Value of a "<field>: <n> kB" line of a /proc file in bytes, None if missing."""
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_rss():
+    """Current resident set size of the process in bytes, 0 if unknown."""
+    return read_proc_kb("/proc/self/status", "VmRSS") or 0
+
+
+def read_peak_rss():
+    """Peak resident set size of the process in bytes."""
+    peak = read_proc_kb("/proc/self/status", "VmHWM")
+    if peak is not None:
+        return peak
+    # not resettable, reported in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the whole process, for scripts measuring a full run."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory(device):
+    """Peak allocated CUDA memory on a GPU, peak RSS on the CPU, in bytes."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return read_peak_rss()
+
+
+def current_memory(device):
+    """Allocated CUDA memory on a GPU, RSS on the CPU, in bytes."""
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+    return read_rss()
+
+
+def reset_peak_memory(device):
+    """Reset the peak memory of the whole process, for scripts measuring a full run."""
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        reset_peak_rss()
+
+
+def available_memory(device):
+    """Memory that can still be allocated in bytes, None if unknown."""
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        # blocks cached by the allocator can be reused as well
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    return read_proc_kb("/proc/meminfo", "MemAvailable")
+
+
+class PeakMemory:
+    """
+    Context manager bounding the memory a block needs at its peak, in bytes on
+    top of the memory in use when it is entered (`peak`, set on exit). As in
+    StageProfiler the peak counters of the process are only read: the bound is
+    exact if the block raises the process peak, and is the earlier process
+    peak otherwise.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.peak = 0
+
+    def __enter__(self):
+        self.start = current_memory(self.device)
+        return self
+
+    def __exit__(self, *args):
+        self.peak = peak_memory(self.device) - self.start
+
+
+class StageProfiler:
+    """
+    Records the wall time and peak memory of named regions.
+
+    Regions may be nested. Memory is the allocated CUDA memory on a GPU and
+    the RSS of the process on the CPU. The peak counters of the process are
+    only read, never reset, so other code measuring peaks is not disturbed:
+    the peak of a region is the process peak if the region raised it, and
+    otherwise the highest memory in use when the region, or a region nested
+    in it, was entered or exited. CUDA is synchronized around every region.
+    """
+
+    def __init__(self, device="cuda"):
+        self.device = torch.device(device)
+        self.reset()
+
+    def reset(self):
+        self.calls = defaultdict(int)
+        self.total_time = defaultdict(float)
+        self.peak_memory = defaultdict(int)
+        # (process peak on entry, peak memory seen so far) of each open region
+        self.stack = []
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _update_open_regions(self, memory):
+        self.stack = [(entry_peak, max(peak, memory)) for entry_peak, peak in self.stack]
+
+    @contextmanager
+    def region(self, name):
+        self._sync()
+        memory = current_memory(self.device)
+        self._update_open_regions(memory)
+        self.stack.append((peak_memory(self.device), memory))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            elapsed = time.perf_counter() - start
+            entry_peak, peak = self.stack.pop()
+            peak = max(peak, current_memory(self.device))
+            process_peak = peak_memory(self.device)
+            if process_peak > entry_peak:
+                peak = max(peak, process_peak)
+            self._update_open_regions(peak)
+
+            self.calls[name] += 1
+            self.total_time[name] += elapsed
+            self.peak_memory[name] = max(self.peak_memory[name], peak)
+
+    def summary(self):
+        return {
+            name: {
+                "calls": self.calls[name],
+                "total_sec": self.total_time[name],
+                "mean_sec": self.total_time[name] / self.calls[name],
+                "peak_memory_mb": self.peak_memory[name] / 2 ** 20,
+            }
+            for name in self.calls
+        }
+
+    def scalars(self, prefix="profile"):
+        """Flat summary, e.g. for Logger.write_dict."""
+        return {
+            f"{prefix}/{name}_{key}": value
+            for name, stats in self.summary().items()
+            for key, value in stats.items()
+            if key != "calls"
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
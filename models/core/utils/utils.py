@@ -4,6 +4,9 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from functools import lru_cache
+
+import torch
 import torch.nn.functional as F
 
 
@@ -16,6 +19,48 @@ def interp(tensor, size):
     )
 
 
+@lru_cache(maxsize=32)
+def normalized_grid(h, w, device, dtype):
+    """Pixel grid [1, h, w, 2] in (x, y) order, scaled to [-1, 1] as grid_sample expects."""
+    grid_y, grid_x = torch.meshgrid(
+        torch.arange(0, h, device=device, dtype=dtype),
+        torch.arange(0, w, device=device, dtype=dtype),
+        indexing="ij",
+    )
+    grid = torch.stack((grid_x, grid_y), 2)
+    scale = grid_scale(h, w, device, dtype)
+    return (grid * scale - 1.0)[None]
+
+
+@lru_cache(maxsize=32)
+def grid_scale(h, w, device, dtype):
+    """Factors that map pixel offsets in (x, y) order to grid_sample units."""
+    return torch.tensor(
+        [2.0 / max(w - 1, 1), 2.0 / max(h - 1, 1)], device=device, dtype=dtype
+    )
+
+
+def flow_warp(x, flow, interpolation="bilinear", padding_mode="zeros", align_corners=True):
+    """Backward-warp x [B, C, H, W] with flow [B, 2, H, W] or [B, H, W, 2] given in pixels."""
+    if flow.size(3) != 2:  # [B, H, W, 2]
+        flow = flow.permute(0, 2, 3, 1)
+    if x.size()[-2:] != flow.size()[1:3]:
+        raise ValueError(f'The spatial sizes of input ({x.size()[-2:]}) and '
+                         f'flow ({flow.size()[1:3]}) are not the same.')
+    _, _, h, w = x.size()
+    # the base grid is cached, so the flow only needs one fused scale-and-add
+    grid = normalized_grid(h, w, flow.device, flow.dtype)
+    grid_flow = torch.addcmul(grid, flow, grid_scale(h, w, flow.device, flow.dtype))
+    # warping is done in the precision of the flow, also under autocast
+    output = F.grid_sample(
+        x.to(grid_flow.dtype),
+        grid_flow,
+        mode=interpolation,
+        padding_mode=padding_mode,
+        align_corners=align_corners)
+    return output
+
+
 class InputPadder:
     """Pads images such that dimensions are divisible by 8"""
 
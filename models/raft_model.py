@@ -19,12 +19,24 @@ raft = importlib.import_module(
 )
 
 
+# RAFT pools its 1/8 correlation volume three times and samples every level
+# bilinearly, which needs at least two pixels per level
+MIN_INPUT_SIZE = 128
+
+
 class RAFTModel(Configurable, torch.nn.Module):
     MODEL_CONFIG_NAME: ClassVar[str] = "RAFTModel"
+    device: str = "cuda"
+    # refinement iterations of RAFT
+    iters: int = 10
+    # RAFT runs on frames average-pooled by this factor (1, 2 or 4), with 4 its
+    # upsampled flow is already at the 1/4 resolution BiDAStereo works at
+    downscale: int = 1
+    # an empty path keeps the random initialization, e.g. for benchmarks
+    model_weights: str = "./third_party/RAFT/models/raft-sintel.pth"
 
     def __post_init__(self):
         super().__init__()
-        self.model_weights: str = "./third_party/RAFT/models/raft-sintel.pth"
 
         model_args = SimpleNamespace(
             mixed_precision=False,
@@ -32,18 +44,37 @@ class RAFTModel(Configurable, torch.nn.Module):
             dropout=0.0,
         )
         self.args = model_args
-        self.model = raft.RAFT(model_args).cuda()
+        self.model = raft.RAFT(model_args).to(self.device)
 
-        state_dict = torch.load(self.model_weights)
-        weight_dict = {}
-        for k,v in state_dict.items():
-            temp_k = k.replace('module.', '') if 'module' in k else k
-            weight_dict[temp_k] = v
-        self.model.load_state_dict(weight_dict)
+        if self.model_weights:
+            state_dict = torch.load(self.model_weights, map_location=self.device)
+            weight_dict = {}
+            for k,v in state_dict.items():
+                temp_k = k.replace('module.', '') if 'module' in k else k
+                weight_dict[temp_k] = v
+            self.model.load_state_dict(weight_dict)
 
 
     def forward(self, image1, image2):
-        flow, flow_up = self.model(image1, image2, iters=10, test_mode=True)
+        """Return the flow from image1 to image2 at 1/4 of the input resolution."""
+        h, w = image1.shape[-2:]
+        if self.downscale > 1:
+            image1 = F.avg_pool2d(image1, self.downscale, stride=self.downscale)
+            image2 = F.avg_pool2d(image2, self.downscale, stride=self.downscale)
+
+        # small (e.g. downscaled) frames are padded at the bottom and right to a
+        # size RAFT supports, and the padding is cropped from the flow
+        ph, pw = image1.shape[-2:]
+        pad_h = max(MIN_INPUT_SIZE, -(-ph // 8) * 8) - ph
+        pad_w = max(MIN_INPUT_SIZE, -(-pw // 8) * 8) - pw
+        if pad_h > 0 or pad_w > 0:
+            image1 = F.pad(image1, [0, pad_w, 0, pad_h], mode="replicate")
+            image2 = F.pad(image2, [0, pad_w, 0, pad_h], mode="replicate")
+
+        flow, flow_up = self.model(image1, image2, iters=self.iters, test_mode=True)
+        flow_up = flow_up[..., :ph, :pw]
 
-        return 0.25 * F.interpolate(flow_up, size=(flow_up.shape[2] // 4, flow_up.shape[3] // 4), mode="bilinear",
+        if flow_up.shape[2:] == (h // 4, w // 4):
+            return flow_up
+        return self.downscale / 4 * F.interpolate(flow_up, size=(h // 4, w // 4), mode="bilinear",
         align_corners=True)
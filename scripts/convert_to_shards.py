@@ -0,0 +1,98 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Decode the frames of a training dataset once into packed shards (see
+datasets/shards.py), which are then read with --data_backend shard:
+
+python ./scripts/convert_to_shards.py --dataset dynamic_replica --split train \
+    --output ./data/shards
+python ./scripts/convert_to_shards.py --dataset sceneflow --dstype frames_cleanpass \
+    --output ./data/shards
+
+The shard of Dynamic Replica is written to <output>/<split>, the shard of
+SceneFlow to <output>/<dstype>, matching the shard_root of the datasets.
+Disparities are stored as float16, Dynamic Replica depths are converted to
+disparities with the camera parameters of each sequence.
+"""
+
+import argparse
+import os.path as osp
+
+import numpy as np
+from tqdm import tqdm
+
+import bidastereo.datasets.bidastereo_datasets as datasets
+from bidastereo.datasets.shards import ShardWriter
+
+
+def get_dataset(args):
+    if args.dataset == "dynamic_replica":
+        return datasets.DynamicReplicaDataset(root=args.root, split=args.split, sample_len=1)
+    elif args.dataset == "sceneflow":
+        return datasets.SequenceSceneFlowDataset(
+            root=args.root,
+            dstype=args.dstype,
+            add_things="things" in args.sceneflow_parts,
+            add_monkaa="monkaa" in args.sceneflow_parts,
+            add_driving="driving" in args.sceneflow_parts,
+        )
+    raise ValueError(f"Unknown dataset {args.dataset}")
+
+
+def sequence_chunks(dataset, sequence, chunk_size):
+    """Yield (images, disparities) of consecutive chunks of a sequence."""
+    # masks are not part of the shards
+    sequence = {k: v for k, v in sequence.items() if k != "mask"}
+    seq_len = len(sequence["image"]["left"])
+    for start in range(0, seq_len, chunk_size):
+        chunk = {
+            k: {cam: frames[start : start + chunk_size] for cam, frames in v.items()}
+            for k, v in sequence.items()
+        }
+        output = dataset._get_output_tensor(chunk)
+        images = np.stack([np.stack(frame) for frame in output["img"]])
+        # the disparity is stored as [-disparity, 0]
+        disparities = np.stack([-np.stack(frame)[..., 0] for frame in output["disp"]])
+        yield images, disparities
+
+
+def main(args):
+    dataset = get_dataset(args)
+    name = args.split if args.dataset == "dynamic_replica" else args.dstype
+    output = osp.join(args.output, name)
+
+    sequences = dataset.sample_list
+    with ShardWriter(output) as writer:
+        for seq_name, sequence in tqdm(sequences.sequence_items(), total=len(sequences.names)):
+            writer.add_sequence(seq_name, sequence_chunks(dataset, sequence, args.chunk_size))
+    print(f"Wrote {len(sequences.names)} sequences to {output}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a dataset into packed shards.")
+    parser.add_argument(
+        "--dataset", default="dynamic_replica", choices=["dynamic_replica", "sceneflow"]
+    )
+    parser.add_argument("--root", default=None, help="dataset root, the dataset default if unset.")
+    parser.add_argument("--split", default="train", help="dynamic replica split.")
+    parser.add_argument("--dstype", default="frames_cleanpass", help="sceneflow pass.")
+    parser.add_argument(
+        "--sceneflow_parts",
+        nargs="+",
+        default=["things", "monkaa", "driving"],
+        help="sceneflow datasets to convert.",
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=16, help="frames decoded at once."
+    )
+    parser.add_argument("--output", default="./data/shards", help="shard root.")
+    args = parser.parse_args()
+    if args.root is None:
+        args.root = (
+            "./dynamic_replica_data" if args.dataset == "dynamic_replica" else "./data/datasets"
+        )
+    main(args)
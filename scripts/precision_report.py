@@ -0,0 +1,156 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Accuracy / memory report of the precision policies of BiDAStereo.
+
+Evaluates a checkpoint on a few reference sequences once per precision
+("fp32", "fp16", "bf16") and reports disparity EPE / TEPE against the ground
+truth, the EPE / TEPE of the predictions against the fp32 predictions, the
+peak memory and the time per frame:
+
+python ./scripts/precision_report.py \
+    --model_weights ./checkpoints/bidastereo_sf_dr.pth \
+    --dataset sintel --dstype clean --precisions fp32 fp16 bf16
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+
+import torch
+from tabulate import tabulate
+
+from bidastereo.evaluation.utils.eval_utils import eval_batch, eval_endpoint_error_sequence
+from bidastereo.evaluation.utils.utils import aggregate_eval_results
+from bidastereo.models.core.model_zoo import model_zoo
+from bidastereo.models.core.utils.profiler import peak_memory, reset_peak_memory
+from bidastereo.scripts.raft_operating_points import get_dataset
+
+
+REPORT_METRICS = [
+    "disp_epe_mean",
+    "disp_temp_epe_mean",
+    "fp32_epe_mean",
+    "fp32_temp_epe_mean",
+]
+
+
+@torch.no_grad()
+def evaluate_precision(model, dataset, num_sequences, fp32_predictions):
+    per_batch_eval_results = []
+    fp32_errors = defaultdict(list)
+    predictions_list = []
+    num_frames = 0
+    model_time = 0.0
+    device = model.model.device
+    reset_peak_memory(device)
+    for seq_idx in range(min(num_sequences, len(dataset))):
+        sequence = dataset[seq_idx]
+        batch_dict = defaultdict(list)
+        batch_dict["stereo_video"] = sequence["img"]
+        batch_dict["disparity"] = sequence["disp"][:, 0].abs()
+        batch_dict["disparity_mask"] = sequence["valid_disp"][:, :1]
+        batch_dict["fg_mask"] = torch.ones_like(batch_dict["disparity_mask"])
+
+        start = time.perf_counter()
+        predictions = model(batch_dict)
+        model_time += time.perf_counter() - start
+
+        disparity = predictions["disparity"][:, :1].clone().cpu()
+        predictions_list.append(disparity)
+        if fp32_predictions is not None:
+            errors = eval_endpoint_error_sequence(
+                disparity, fp32_predictions[seq_idx].clone(), torch.ones_like(disparity)
+            )
+            for name in ("epe_mean", "temp_epe_mean"):
+                fp32_errors[f"fp32_{name}"].append(errors[name].item())
+
+        predictions["disparity"] = disparity * batch_dict["disparity_mask"].round()
+        per_batch_eval_results.append(eval_batch(batch_dict, predictions))
+        num_frames += len(batch_dict["stereo_video"])
+
+    result = {
+        str(k): v for k, v in aggregate_eval_results(per_batch_eval_results).items()
+    }
+    for name, errors in fp32_errors.items():
+        result[name] = sum(errors) / len(errors)
+    result["peak_memory_mb"] = peak_memory(device) / 2 ** 20
+    result["model_sec_per_frame"] = model_time / num_frames
+    return result, predictions_list
+
+
+def main(args):
+    model = model_zoo(
+        "BiDAStereoModel",
+        BiDAStereoModel={
+            "model_weights": args.model_weights,
+            "kernel_size": args.kernel_size,
+            "device": args.device,
+        },
+    )
+    dataset = get_dataset(args)
+
+    # the fp32 predictions are the reference of the other precisions
+    precisions = ["fp32"] + [p for p in args.precisions if p != "fp32"]
+    fp32_predictions = None
+    report = []
+    for precision in precisions:
+        if precision == "fp16" and args.device == "cpu":
+            print("Skipping fp16, it needs a GPU.")
+            continue
+        model.model.precision = precision
+        result, predictions = evaluate_precision(
+            model, dataset, args.num_sequences, fp32_predictions
+        )
+        if precision == "fp32":
+            fp32_predictions = predictions
+            result.update(fp32_epe_mean=0.0, fp32_temp_epe_mean=0.0)
+        result["precision"] = precision
+        report.append(result)
+
+    columns = ["precision"] + REPORT_METRICS + ["peak_memory_mb", "model_sec_per_frame"]
+    print(tabulate([[row[c] for c in columns] for row in report], headers=columns))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Dumping the report to {args.output}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Accuracy / memory report of the precision policies."
+    )
+    parser.add_argument("--model_weights", type=str, required=True)
+    parser.add_argument(
+        "--dataset",
+        default="sintel",
+        choices=["sintel", "dynamicreplica"],
+        help="evaluation dataset.",
+    )
+    parser.add_argument("--dstype", default="clean", help="sintel pass.")
+    parser.add_argument(
+        "--sample_len", type=int, default=150, help="dynamic replica sequence length."
+    )
+    parser.add_argument(
+        "--num_sequences", type=int, default=5, help="number of evaluated sequences."
+    )
+    parser.add_argument("--kernel_size", type=int, default=20)
+    parser.add_argument("--device", default="cuda", choices=["cuda", "cpu"])
+    parser.add_argument(
+        "--precisions",
+        nargs="+",
+        default=["fp32", "fp16", "bf16"],
+        choices=["fp32", "fp16", "bf16"],
+        help="precision policies, fp32 is always run as the reference.",
+    )
+    parser.add_argument(
+        "--output", default="./outputs/precision_report.json", help="report file."
+    )
+    main(parser.parse_args())
@@ -0,0 +1,145 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Precompute the RAFT flows of the right view used by BiDAStereo for training.
+
+RAFT is frozen during training, so the flows between adjacent frames of every
+training sample can be computed once and loaded by the dataset instead:
+
+python ./scripts/precompute_flows.py --train_datasets things monkaa driving \
+    --sample_len 5 --flow_root ./data/flows
+python train_bidastereo.py ... --flow_root ./data/flows
+
+--train_datasets and --sample_len must match the training run. The samples of
+Dynamic Replica use random frame steps, they are drawn with the same seed as in
+train_bidastereo.py. Flows that already exist are skipped.
+"""
+
+import argparse
+import copy
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+import bidastereo.datasets.bidastereo_datasets as datasets
+from bidastereo.datasets import frame_utils
+from bidastereo.models.core.utils.utils import InputPadder
+from bidastereo.models.raft_model import RAFTModel
+
+
+def get_datasets(dataset):
+    if hasattr(dataset, "datasets"):
+        for d in dataset.datasets:
+            yield from get_datasets(d)
+    else:
+        yield dataset
+
+
+def read_image(path):
+    img = np.array(frame_utils.read_gen(path)).astype(np.uint8)
+    # grayscale images
+    if len(img.shape) == 2:
+        img = np.tile(img[..., None], (1, 1, 3))
+    else:
+        img = img[..., :3]
+    return torch.from_numpy(img).permute(2, 0, 1).float()
+
+
+@torch.no_grad()
+def compute_flows(raft, image1, image2):
+    """Forward and backward flows between two frames at 1/4 resolution."""
+    h, w = image1.shape[-2:]
+    ims = torch.stack([image1, image2])
+    padder = InputPadder(ims.shape, divis_by=32)
+    ims = padder.pad(ims)[0]
+
+    # both directions in one call, as in BiDAStereo.compute_flow
+    flows = raft(ims[[0, 1]], ims[[1, 0]])
+    if flows.shape[-2:] != (h // 4, w // 4):
+        flows = 4 * F.interpolate(
+            flows, scale_factor=4, mode="bilinear", align_corners=True
+        )
+        flows = 1 / 4 * F.interpolate(
+            padder.unpad(flows), size=(h // 4, w // 4), mode="bilinear", align_corners=True
+        )
+    flow_backward, flow_forward = flows.permute(0, 2, 3, 1).cpu().numpy()
+    return flow_forward, flow_backward
+
+
+def main(args):
+    # the same seed as in train_bidastereo.py, so that the samples match
+    np.random.seed(0)
+    dataset_args = copy.copy(args)
+    dataset_args.flow_root = None
+    train_loader = datasets.fetch_dataloader(dataset_args)
+
+    pairs = set()
+    for dataset in get_datasets(train_loader.dataset):
+        for sample in dataset.sample_list:
+            images = sample["image"]["right"]
+            pairs.update(
+                (dataset.root, *pair) for pair in zip(images[:-1], images[1:])
+            )
+    pairs = sorted(
+        pair
+        for pair in pairs
+        if not os.path.isfile(datasets.get_flow_path(args.flow_root, *pair))
+    )
+    print(f"Computing flows for {len(pairs)} frame pairs")
+
+    raft = RAFTModel(device=args.device, iters=args.raft_iters)
+    raft.eval()
+    for root, image1, image2 in tqdm(pairs):
+        flow_forward, flow_backward = compute_flows(
+            raft,
+            read_image(image1).to(args.device),
+            read_image(image2).to(args.device),
+        )
+        path = datasets.get_flow_path(args.flow_root, root, image1, image2)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that interrupted runs leave no partial flows
+        tmp_path = path[: -len(".npz")] + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            forward=flow_forward.astype(np.float16),
+            backward=flow_backward.astype(np.float16),
+        )
+        os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the RAFT flows of the BiDAStereo training samples."
+    )
+    parser.add_argument(
+        "--flow_root", required=True, help="output directory of the flows."
+    )
+    parser.add_argument(
+        "--train_datasets",
+        nargs="+",
+        default=["things", "monkaa", "driving"],
+        help="training datasets.",
+    )
+    parser.add_argument(
+        "--sample_len", type=int, default=5, help="length of training video samples"
+    )
+    parser.add_argument(
+        "--raft_iters", type=int, default=10, help="RAFT iterations of the model."
+    )
+    parser.add_argument("--device", default="cuda", choices=["cuda", "cpu"])
+    args = parser.parse_args()
+
+    # only used to build the training datasets, flows are computed on full frames
+    args.image_size = [320, 720]
+    args.spatial_scale = [0, 0]
+    args.noyjitter = False
+    args.batch_size = 1
+    args.num_workers = 0
+    main(args)
@@ -0,0 +1,175 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Accuracy / speed report for the RAFT alignment flow of BiDAStereo.
+
+Evaluates a checkpoint once per (RAFT iterations, RAFT downscale) setting and
+reports disparity EPE / TEPE together with the time spent in RAFT and in the
+whole model, so that an operating point can be chosen for a latency budget.
+
+python ./scripts/raft_operating_points.py \
+    --model_weights ./checkpoints/bidastereo_sf_dr.pth \
+    --dataset sintel --dstype clean --raft_iters 10 6 3 --raft_downscales 1 2 4
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+
+import torch
+from tabulate import tabulate
+
+import bidastereo.datasets.bidastereo_datasets as datasets
+from bidastereo.evaluation.utils.eval_utils import eval_batch
+from bidastereo.evaluation.utils.utils import aggregate_eval_results
+from bidastereo.models.core.model_zoo import model_zoo
+
+
+REPORT_METRICS = [
+    "disp_epe_mean",
+    "disp_temp_epe_mean",
+    "disp_epe_bad_1px",
+    "disp_temp_epe_bad_1px",
+]
+
+
+class Timer:
+    """Accumulates the wall time spent in the forward calls of a module."""
+
+    def __init__(self, module, device):
+        self.device = device
+        self.total = 0.0
+        module.register_forward_pre_hook(self._start)
+        module.register_forward_hook(self._stop)
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _start(self, module, inputs):
+        self._sync()
+        self._t0 = time.perf_counter()
+
+    def _stop(self, module, inputs, outputs):
+        self._sync()
+        self.total += time.perf_counter() - self._t0
+
+
+def get_dataset(args):
+    if args.dataset == "dynamicreplica":
+        return datasets.DynamicReplicaDataset(
+            split="test", sample_len=args.sample_len, only_first_n_samples=1
+        )
+    elif args.dataset == "sintel":
+        return datasets.SequenceSintelStereo(dstype=args.dstype)
+    raise ValueError(f"Unknown dataset {args.dataset}")
+
+
+@torch.no_grad()
+def evaluate_setting(model, dataset, num_sequences, raft_timer):
+    per_batch_eval_results = []
+    num_frames = 0
+    raft_timer.total = 0.0
+    model_time = 0.0
+    for seq_idx in range(min(num_sequences, len(dataset))):
+        sequence = dataset[seq_idx]
+        batch_dict = defaultdict(list)
+        batch_dict["stereo_video"] = sequence["img"]
+        batch_dict["disparity"] = sequence["disp"][:, 0].abs()
+        batch_dict["disparity_mask"] = sequence["valid_disp"][:, :1]
+        batch_dict["fg_mask"] = torch.ones_like(batch_dict["disparity_mask"])
+
+        start = time.perf_counter()
+        predictions = model(batch_dict)
+        model_time += time.perf_counter() - start
+
+        predictions["disparity"] = predictions["disparity"][:, :1].clone().cpu()
+        predictions["disparity"] = predictions["disparity"] * (
+            batch_dict["disparity_mask"].round()
+        )
+        per_batch_eval_results.append(eval_batch(batch_dict, predictions))
+        num_frames += len(batch_dict["stereo_video"])
+
+    result = {
+        str(k): v for k, v in aggregate_eval_results(per_batch_eval_results).items()
+    }
+    result["raft_sec_per_frame"] = raft_timer.total / num_frames
+    result["model_sec_per_frame"] = model_time / num_frames
+    return result
+
+
+def main(args):
+    model = model_zoo(
+        "BiDAStereoModel",
+        BiDAStereoModel={
+            "model_weights": args.model_weights,
+            "kernel_size": args.kernel_size,
+            "device": args.device,
+        },
+    )
+    raft = model.model.raft
+    raft_timer = Timer(raft, torch.device(args.device))
+    dataset = get_dataset(args)
+
+    report = []
+    for raft_iters in args.raft_iters:
+        for raft_downscale in args.raft_downscales:
+            raft.iters = raft_iters
+            raft.downscale = raft_downscale
+            result = evaluate_setting(model, dataset, args.num_sequences, raft_timer)
+            result["raft_iters"] = raft_iters
+            result["raft_downscale"] = raft_downscale
+            report.append(result)
+
+    columns = ["raft_iters", "raft_downscale"] + REPORT_METRICS + [
+        "raft_sec_per_frame",
+        "model_sec_per_frame",
+    ]
+    print(tabulate([[row[c] for c in columns] for row in report], headers=columns))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Dumping the report to {args.output}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Accuracy / speed report of the RAFT alignment flow settings."
+    )
+    parser.add_argument("--model_weights", type=str, required=True)
+    parser.add_argument(
+        "--dataset",
+        default="sintel",
+        choices=["sintel", "dynamicreplica"],
+        help="evaluation dataset.",
+    )
+    parser.add_argument("--dstype", default="clean", help="sintel pass.")
+    parser.add_argument(
+        "--sample_len", type=int, default=150, help="dynamic replica sequence length."
+    )
+    parser.add_argument(
+        "--num_sequences", type=int, default=5, help="number of evaluated sequences."
+    )
+    parser.add_argument("--kernel_size", type=int, default=20)
+    parser.add_argument("--device", default="cuda", choices=["cuda", "cpu"])
+    parser.add_argument(
+        "--raft_iters", type=int, nargs="+", default=[10, 6, 3], help="RAFT iterations."
+    )
+    parser.add_argument(
+        "--raft_downscales",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="downscale factors of the RAFT input frames.",
+    )
+    parser.add_argument(
+        "--output", default="./outputs/raft_operating_points.json", help="report file."
+    )
+    main(parser.parse_args())
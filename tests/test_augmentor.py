@@ -0,0 +1,84 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+
+from bidastereo.datasets.augmentor import SequenceDispFlowAugmentor
+
+CROP_SIZE = (64, 96)
+FLOW = ((1.5, -0.5), (-1.5, 0.5))
+
+
+def build_augmentor(yjitter, scale=0.0):
+    # geometry only: the images keep the pixel coordinates they encode
+    augmentor = SequenceDispFlowAugmentor(
+        CROP_SIZE, min_scale=scale, max_scale=scale, yjitter=yjitter
+    )
+    augmentor.stretch_prob = 0.0
+    augmentor.photo_aug = lambda image: image
+    augmentor.eraser_aug_prob = 0.0
+    return augmentor
+
+
+def build_sample(num_frames=4, ht=100, wd=160, flow=None):
+    # rows and columns of every pixel in the first two channels
+    rows, cols = np.meshgrid(np.arange(ht), np.arange(wd), indexing="ij")
+    image = np.stack([rows, cols, np.zeros_like(rows)], axis=-1).astype(np.uint8)
+    img = [[image.copy(), image.copy()] for _ in range(num_frames)]
+    disp = [[] for _ in range(num_frames)]
+    if flow is None:
+        flow = lambda direction: np.full((ht // 4, wd // 4, 2), FLOW[direction])
+    flows = [
+        [flow(direction).astype(np.float32) for direction in (0, 1)]
+        for _ in range(num_frames - 1)
+    ]
+    return img, disp, flows
+
+
+@pytest.mark.parametrize("yjitter", [False, True])
+def test_constant_flows_are_cropped_and_corrected_for_jitter(yjitter):
+    np.random.seed(0)
+    augmentor = build_augmentor(yjitter)
+    for _ in range(10):
+        img, disp, flow = augmentor(*build_sample())
+        # crop offsets of the right view, read back from its pixels
+        y_right = [int(img[i][1][0, 0, 0]) for i in range(len(img))]
+        for i in range(len(flow)):
+            for direction, (src, dst) in enumerate([(i + 1, i), (i, i + 1)]):
+                f = flow[i][direction]
+                assert f.shape == (CROP_SIZE[0] // 4, CROP_SIZE[1] // 4, 2)
+                assert f.dtype == np.float32
+                dy = (y_right[src] - y_right[dst]) / 4
+                np.testing.assert_allclose(f[..., 0], FLOW[direction][0])
+                np.testing.assert_allclose(f[..., 1], FLOW[direction][1] + dy)
+
+
+def test_flows_follow_the_crop():
+    # a flow whose x component is the column of the 1/4 grid it lies on
+    np.random.seed(0)
+    augmentor = build_augmentor(yjitter=False)
+    ramp = lambda direction: np.stack(np.meshgrid(np.arange(40), np.zeros(25)), -1)
+    for _ in range(10):
+        img, disp, flow = augmentor(*build_sample(flow=ramp))
+        x0 = int(img[0][0][0, 0, 1])
+        expected = np.arange(CROP_SIZE[1] // 4) + x0 / 4
+        for i in range(len(flow)):
+            for direction in (0, 1):
+                f = flow[i][direction]
+                np.testing.assert_allclose(f[..., 0], np.tile(expected, (16, 1)), atol=1e-5)
+
+
+def test_flows_are_scaled_with_the_images():
+    np.random.seed(0)
+    augmentor = build_augmentor(yjitter=False, scale=1.0)
+    img, disp, flow = augmentor(*build_sample())
+    assert img[0][0].shape[:2] == CROP_SIZE
+    for i in range(len(flow)):
+        for direction in (0, 1):
+            f = flow[i][direction]
+            assert f.shape == (CROP_SIZE[0] // 4, CROP_SIZE[1] // 4, 2)
+            np.testing.assert_allclose(f, np.tile(FLOW[direction], (16, 24, 1)) * 2)
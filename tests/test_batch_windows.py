@@ -0,0 +1,104 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from bidastereo.benchmarks.utils import build_model, synthetic_video
+from bidastereo.models.core.corr import TFCL, TFCLVolume
+
+# CPU convolutions pick their kernels by batch size, so batched windows only
+# match the sequential ones up to rounding, far below the error of mixing up
+# the features of different windows (~2e-3 px)
+ATOL = 1e-5
+
+
+@pytest.mark.parametrize("tfcl", [TFCL, TFCLVolume])
+def test_tfcl_keeps_windows_apart(tfcl):
+    # fmap2 holds the three groups of a batch of windows group-major, as
+    # BiDAStereo.forward builds it
+    torch.manual_seed(0)
+    num_windows, T, C, H, W = 2, 3, 16, 8, 12
+    fmap1 = torch.randn(num_windows, T, C, H, W)
+    fmap2 = torch.randn(3, num_windows, T, C, H, W)
+    flow = torch.zeros(num_windows, T, 2, H, W)
+    flow[:, :, 0] = -4 * torch.rand(num_windows, T, H, W)
+
+    batched = tfcl(fmap1.flatten(0, 1), fmap2.flatten(0, 2))
+    for small_patch in (False, True):
+        corr = batched(flow.flatten(0, 1), None, small_patch=small_patch)
+        for w in range(num_windows):
+            window = tfcl(fmap1[w], fmap2[:, w].flatten(0, 1))
+            expected = window(flow[w], None, small_patch=small_patch)
+            assert torch.equal(corr[w * T : (w + 1) * T], expected)
+
+
+def test_identical_windows_in_a_batch():
+    model = build_model("cpu")
+    video = synthetic_video(4, 128, 128)
+    left, right = video[:, 0][None], video[:, 1][None]
+    with torch.no_grad():
+        flows_forward, flows_backward = model.compute_flow(right)
+        flows = (torch.stack(flows_forward, dim=1), torch.stack(flows_backward, dim=1))
+        single = model(left, right, iters=2, test_mode=True, flows=flows)
+        pair = model(
+            torch.cat([left, left]),
+            torch.cat([right, right]),
+            iters=2,
+            test_mode=True,
+            flows=tuple(torch.cat([f, f]) for f in flows),
+        )
+    torch.testing.assert_close(pair[:, :1], single, rtol=0, atol=ATOL)
+    torch.testing.assert_close(pair[:, 1:], single, rtol=0, atol=ATOL)
+
+
+def test_batched_windows_match_sequential():
+    video = synthetic_video(8, 128, 128)
+    disparities = []
+    for max_batch_windows in (1, 4):
+        model = build_model("cpu", max_batch_windows=max_batch_windows)
+        with torch.no_grad():
+            predictions = model.forward_batch_test(
+                {"stereo_video": video}, kernel_size=4, iters=2
+            )
+        disparities.append(predictions["disparity"])
+    assert torch.isfinite(disparities[0]).all()
+    torch.testing.assert_close(disparities[1], disparities[0], rtol=0, atol=ATOL)
+
+
+@pytest.mark.parametrize("stitching", ["linear", "cosine"])
+def test_batched_windows_match_sequential_when_blending_to_disk(stitching, tmp_path):
+    video = synthetic_video(8, 128, 128)
+    disparities = []
+    for max_batch_windows in (1, 4):
+        model = build_model("cpu", max_batch_windows=max_batch_windows)
+        # the disparities are memory-mapped from a file in output_dir
+        output_dir = tmp_path / str(max_batch_windows)
+        output_dir.mkdir()
+        with torch.no_grad():
+            predictions = model.forward_batch_test(
+                {"stereo_video": video},
+                kernel_size=4,
+                iters=2,
+                stitching=stitching,
+                output_dir=str(output_dir),
+            )
+        disparities.append(predictions["disparity"])
+    assert torch.isfinite(disparities[0]).all()
+    torch.testing.assert_close(disparities[1], disparities[0], rtol=0, atol=ATOL)
+
+
+def test_prefetched_windows_match_synchronous_windows():
+    # run_windows prepares the next window on a worker thread
+    model = build_model("cpu")
+    video = synthetic_video(8, 128, 128)
+    starts = [0, 2, 4]
+    with torch.no_grad():
+        outputs = dict(model.run_windows(video, starts, 4, iters=2))
+        for start in starts:
+            window = video[start : start + 4]
+            expected = model.forward_window(window[:, 0], window[:, 1], iters=2)
+            torch.testing.assert_close(outputs[start], expected, rtol=0, atol=ATOL)
@@ -0,0 +1,117 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from bidastereo.benchmarks.utils import build_model, synthetic_video
+
+# CPU kernels are picked by batch size, so the same frames run in batches of
+# different sizes only match up to rounding
+ATOL = 1e-5
+
+
+def right_view(video):
+    return video[:, 1][None]
+
+
+def test_cached_flows_match_computed_flows():
+    model = build_model("cpu")
+    video = right_view(synthetic_video(6, 64, 96))
+    with torch.no_grad():
+        flow_cache = {}
+        model.compute_flow(video[:, :4], flow_cache=flow_cache)
+        # frames 2 and 3 of the second window are in the cache
+        cached = model.compute_flow(video[:, 2:], flow_cache=flow_cache, frame_offset=2)
+        expected = model.compute_flow(video[:, 2:])
+    assert sorted(flow_cache) == [(i, i + 1) for i in range(5)]
+    for cached_flows, flows in zip(cached, expected):
+        for cached_flow, flow in zip(cached_flows, flows):
+            torch.testing.assert_close(cached_flow, flow, rtol=0, atol=ATOL)
+
+
+def test_cpu_inference():
+    model = build_model("cpu")
+    assert model.device == torch.device("cpu")
+    tensors = list(model.parameters()) + list(model.buffers())
+    assert all(tensor.device.type == "cpu" for tensor in tensors)
+    with torch.no_grad():
+        predictions = model.forward_batch_test(
+            {"stereo_video": synthetic_video(3, 64, 96)}, kernel_size=4, iters=2
+        )
+    disparity = predictions["disparity"]
+    assert disparity.device.type == "cpu"
+    assert disparity.shape == (3, 1, 64, 96)
+    assert torch.isfinite(disparity).all()
+
+
+@pytest.mark.parametrize("raft_batch_size", [0, 3])
+def test_batched_flows_match_flows_of_each_pair(raft_batch_size):
+    model = build_model("cpu", raft_batch_size=raft_batch_size)
+    video = right_view(synthetic_video(4, 64, 96))
+    with torch.no_grad():
+        flows_forward, flows_backward = model.compute_flow(video)
+        for i in range(3):
+            prev_ims, next_ims = video[:, i], video[:, i + 1]
+            expected_forward = model.raft(next_ims, prev_ims)
+            expected_backward = model.raft(prev_ims, next_ims)
+            torch.testing.assert_close(flows_forward[i], expected_forward, rtol=0, atol=ATOL)
+            torch.testing.assert_close(flows_backward[i], expected_backward, rtol=0, atol=ATOL)
+
+
+def test_test_mode_returns_the_last_prediction():
+    # test_mode only upsamples the last iteration of each level
+    model = build_model("cpu")
+    video = synthetic_video(3, 64, 96)
+    left, right = video[:, 0][None], video[:, 1][None]
+    with torch.no_grad():
+        predictions = model(left, right, iters=2)
+        disparities = model(left, right, iters=2, test_mode=True)
+    assert predictions.shape == (1 + 1 + 2, 3, 1, 1, 64, 96)
+    assert torch.equal(disparities, predictions[-1])
+
+
+def test_early_exit():
+    video = synthetic_video(3, 64, 96)
+    left, right = video[:, 0][None], video[:, 1][None]
+    disparities, iterations = [], []
+    # 0 disables the early exit, 1e-12 never stops early, 1e6 stops at once
+    for threshold in (0, 1e-12, 1e6):
+        model = build_model("cpu", early_exit_threshold=threshold)
+        iters_used = {}
+        with torch.no_grad():
+            disparities.append(
+                model(left, right, iters=4, test_mode=True, iters_used=iters_used)
+            )
+        iterations.append(iters_used)
+    assert torch.equal(disparities[1], disparities[0])
+    assert iterations[:2] == [{16: 2, 8: 2, 4: 4}] * 2
+    assert iterations[2] == {16: 1, 8: 1, 4: 1}
+
+
+def test_precision_policies():
+    video = synthetic_video(4, 64, 96)
+    disparities = {}
+    for precision in ("fp32", "bf16"):
+        model = build_model("cpu", precision=precision)
+        with torch.no_grad():
+            predictions = model.forward_batch_test(
+                {"stereo_video": video}, kernel_size=4, iters=2
+            )
+        disparities[precision] = predictions["disparity"]
+    with torch.no_grad():
+        default = build_model("cpu").forward_batch_test(
+            {"stereo_video": video}, kernel_size=4, iters=2
+        )
+    assert torch.equal(disparities["fp32"], default["disparity"])
+
+    # bf16 keeps 8 bits of mantissa, the outputs stay in fp32
+    assert disparities["bf16"].dtype == torch.float32
+    error = (disparities["bf16"] - disparities["fp32"]).abs().mean()
+    assert error < 0.05 * disparities["fp32"].abs().mean()
+
+    with pytest.raises(ValueError):
+        build_model("cpu", precision="fp16")
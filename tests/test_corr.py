@@ -0,0 +1,82 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from bidastereo.models.core.corr import (
+    TFCL,
+    TFCLVolume,
+    bilinear_sampler,
+    coords_grid,
+    horizontal_sampler,
+)
+
+
+def random_features(n=2, c=16, h=6, w=10, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return torch.randn(n, c, h, w, generator=g), torch.randn(n, c, h, w, generator=g)
+
+
+@pytest.mark.parametrize("psize", [(1, 9), (3, 3)])
+@pytest.mark.parametrize("max_corr_elements", [2 ** 28, 1])
+def test_batched_correlation_matches_loop(psize, max_corr_elements, monkeypatch):
+    # the CPU runs the per-offset loop of get_correlation, CUDA the batched product
+    left, right = random_features()
+    monkeypatch.setattr(TFCL, "max_corr_elements", max_corr_elements)
+    tfcl = TFCL(left, torch.cat([right] * 3))
+    pady, padx = psize[0] // 2, psize[1] // 2
+    right_pad = F.pad(right, [padx, padx, pady, pady], mode="replicate")
+
+    expected = tfcl.get_correlation(left, right, psize)
+    batched = tfcl.batched_correlation(left, right_pad)
+    assert batched.shape == expected.shape == (2, psize[0] * psize[1], 6, 10)
+    torch.testing.assert_close(batched, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_horizontal_sampler_matches_bilinear_sampler():
+    # with a zero vertical flow every sample lies on a row, where bilinear
+    # sampling reduces to linear interpolation along x
+    left, right = random_features()
+    rights = torch.cat([right, right.flip(0), -right])
+    coords = coords_grid(2, 6, 10, "cpu")
+    g = torch.Generator().manual_seed(1)
+    # columns up to 8 px outside the image on both sides
+    xgrid = coords[:, :1] + 16 * torch.rand(2, 1, 6, 10, generator=g) - 8
+
+    sampled = horizontal_sampler(rights, xgrid)
+    grid = torch.cat([xgrid, coords[:, 1:]], dim=1).permute(0, 2, 3, 1)
+    expected = bilinear_sampler(rights, grid.repeat(3, 1, 1, 1))
+    torch.testing.assert_close(sampled, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_tfcl_ignores_and_keeps_the_vertical_flow():
+    left, right = random_features()
+    tfcl = TFCL(left, torch.cat([right, right.flip(0), -right]))
+    flow = torch.randn(2, 2, 6, 10, generator=torch.Generator().manual_seed(2))
+    flow_copy = flow.clone()
+    horizontal = flow.clone()
+    horizontal[:, 1:] = 0
+
+    for small_patch in (False, True):
+        corr = tfcl(flow, None, small_patch=small_patch)
+        assert torch.equal(flow, flow_copy)
+        assert torch.equal(corr, tfcl(horizontal, None, small_patch=small_patch))
+
+
+def test_correlation_volume_matches_tfcl():
+    left, right = random_features()
+    rights = torch.cat([right, right.flip(0), -right])
+    flow = torch.zeros(2, 2, 6, 10)
+    # disparities reaching past the left image border
+    flow[:, 0] = -12 * torch.rand(2, 6, 10, generator=torch.Generator().manual_seed(3))
+
+    tfcl, volume = TFCL(left, rights), TFCLVolume(left, rights)
+    for small_patch in (False, True):
+        expected = tfcl(flow, None, small_patch=small_patch)
+        corr = volume(flow, None, small_patch=small_patch)
+        torch.testing.assert_close(corr, expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,193 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import gzip
+import json
+import os
+import os.path as osp
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from bidastereo.datasets.bidastereo_datasets import (
+    DynamicReplicaDataset,
+    SequenceSceneFlowDataset,
+    get_flow_path,
+)
+from bidastereo.scripts import convert_to_shards
+
+HEIGHT, WIDTH = 48, 64
+
+
+def write_pfm(path, data):
+    with open(path, "wb") as f:
+        f.write(b"Pf\n")
+        f.write(f"{data.shape[1]} {data.shape[0]}\n".encode())
+        f.write(b"-1\n")
+        np.flipud(data).astype("<f4").tofile(f)
+
+
+@pytest.fixture
+def scene_flow_root(tmp_path):
+    """Two Monkaa sequences of random frames and disparities."""
+    rng = np.random.default_rng(0)
+    for seq, num_frames in (("a", 7), ("b", 5)):
+        for cam in ("left", "right"):
+            image_dir = tmp_path / "Monkaa" / "frames_cleanpass" / seq / cam
+            disparity_dir = tmp_path / "Monkaa" / "disparity" / seq / cam
+            os.makedirs(image_dir)
+            os.makedirs(disparity_dir)
+            for t in range(num_frames):
+                image = rng.integers(0, 255, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+                Image.fromarray(image).save(image_dir / f"{t:04d}.png")
+                disparity = 100 * rng.random((HEIGHT, WIDTH), dtype=np.float32)
+                write_pfm(disparity_dir / f"{t:04d}.pfm", disparity)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def dynamic_replica_root(tmp_path):
+    """
+    Train split of two Dynamic Replica sequences, one of them misses a depth
+    map and is skipped.
+    """
+    annotations = []
+    for seq, num_frames in (("a", 20), ("b", 6)):
+        for cam in ("left", "right"):
+            for t in range(num_frames):
+                paths = {}
+                for k in ("images", "depths", "masks"):
+                    paths[k] = f"{seq}/{cam}/{k}/{t:04d}.png"
+                    if k == "depths" and seq == "b" and t == 3:
+                        continue
+                    path = tmp_path / "train" / paths[k]
+                    os.makedirs(path.parent, exist_ok=True)
+                    Image.new("L", (WIDTH, HEIGHT)).save(path)
+                viewpoint = {
+                    "R": np.eye(3).tolist(),
+                    "T": [0.1 * (cam == "right"), 0.01 * t, 0.0],
+                    "focal_length": [1.5, 1.5],
+                    "principal_point": [0.0, 0.0],
+                    "intrinsics_format": "ndc_isotropic",
+                }
+                annotations.append(
+                    {
+                        "sequence_name": seq,
+                        "frame_number": t,
+                        "frame_timestamp": float(t),
+                        "camera_name": cam,
+                        "image": {"path": paths["images"], "size": [HEIGHT, WIDTH]},
+                        "depth": {"path": paths["depths"], "scale_adjustment": 1.0},
+                        "mask": {"path": paths["masks"]},
+                        "viewpoint": viewpoint,
+                    }
+                )
+    with gzip.open(tmp_path / "train" / "frame_annotations_train.jgz", "wt") as f:
+        json.dump(annotations, f)
+    return str(tmp_path)
+
+
+def as_lists(values):
+    if isinstance(values, dict):
+        return {k: as_lists(v) for k, v in values.items()}
+    if isinstance(values, np.ndarray) and values.dtype.names is not None:
+        return [[row[f].tolist() for f in values.dtype.names] for row in values]
+    return list(values)
+
+
+def test_cached_annotation_index(dynamic_replica_root):
+    samples = []
+    for _ in range(2):
+        # the second dataset reads the index cached by the first one
+        np.random.seed(0)
+        dataset = DynamicReplicaDataset(root=dynamic_replica_root, sample_len=2)
+        samples.append([as_lists(sample) for sample in dataset.sample_list])
+    split_root = osp.join(dynamic_replica_root, "train")
+    assert osp.isfile(osp.join(split_root, "frame_annotations_train.index.npz"))
+    assert samples[0] == samples[1]
+
+    assert {sample["metadata"]["left"][0][0] for sample in samples[0]} == {"a"}
+    for sample in dataset.sample_list:
+        images = sample["image"]["right"]
+        frames = [int(osp.splitext(osp.basename(path))[0]) for path in images]
+        # the viewpoints of the frames, a structured array
+        viewpoints = sample["viewpoint"]["right"]
+        np.testing.assert_allclose(viewpoints["T"][:, 1], 0.01 * np.array(frames))
+        assert viewpoints["intrinsics_format"].tolist() == ["ndc_isotropic"] * 2
+
+
+def build_dataset(root, **kwargs):
+    return SequenceSceneFlowDataset(
+        root=root, sample_len=3, add_things=False, add_driving=False, **kwargs
+    )
+
+
+@pytest.mark.parametrize("decode_threads", [0, 2])
+def test_precomputed_flows(scene_flow_root, tmp_path, decode_threads):
+    flow_root = str(tmp_path / "flows")
+    dataset = build_dataset(
+        scene_flow_root, flow_root=flow_root, decode_threads=decode_threads
+    )
+    # flows with the frame index they start from
+    for sample in dataset.sample_list:
+        images = sample["image"]["right"]
+        for image1, image2 in zip(images[:-1], images[1:]):
+            path = get_flow_path(flow_root, scene_flow_root, image1, image2)
+            assert path.startswith(osp.join(flow_root, "Monkaa", ""))
+            os.makedirs(osp.dirname(path), exist_ok=True)
+            start = int(osp.splitext(osp.basename(image1))[0])
+            flow = np.full((HEIGHT // 4, WIDTH // 4, 2), start, dtype=np.float16)
+            np.savez(path, forward=flow, backward=-flow)
+
+    for index, sample in enumerate(dataset.sample_list):
+        flows = dataset[index]["flow"]
+        assert flows.shape == (2, 2, 2, HEIGHT // 4, WIDTH // 4)
+        for i, image in enumerate(sample["image"]["right"][:-1]):
+            start = int(osp.splitext(osp.basename(image))[0])
+            assert torch.equal(flows[i, 0], torch.full_like(flows[i, 0], start))
+            assert torch.equal(flows[i, 1], torch.full_like(flows[i, 1], -start))
+
+
+def test_shard_backend_matches_files(scene_flow_root, tmp_path):
+    shard_root = str(tmp_path / "shards")
+    args = argparse.Namespace(
+        dataset="sceneflow",
+        root=scene_flow_root,
+        dstype="frames_cleanpass",
+        sceneflow_parts=["monkaa"],
+        chunk_size=4,
+        output=shard_root,
+    )
+    convert_to_shards.main(args)
+
+    files = build_dataset(scene_flow_root)
+    shards = build_dataset(scene_flow_root, backend="shard", shard_root=shard_root)
+    assert len(shards) == len(files)
+    assert "shard" in shards.sample_list[0]
+    for index in range(len(files)):
+        expected, sample = files[index], shards[index]
+        assert sample.keys() == expected.keys()
+        assert torch.equal(sample["img"], expected["img"])
+        assert torch.equal(sample["valid_disp"], expected["valid_disp"])
+        # the shards store the disparities as float16
+        torch.testing.assert_close(sample["disp"], expected["disp"], rtol=1e-3, atol=0)
+
+
+def test_decode_pool_matches_serial_decoding(scene_flow_root):
+    serial = build_dataset(scene_flow_root)
+    expected = [serial[index] for index in range(len(serial))]
+    pooled = build_dataset(scene_flow_root, decode_threads=4)
+    # the workers start their own pools
+    loader = torch.utils.data.DataLoader(pooled, batch_size=None, num_workers=2)
+    for samples in ([pooled[index] for index in range(len(pooled))], list(loader)):
+        assert len(samples) == len(expected)
+        for sample, reference in zip(samples, expected):
+            assert sample.keys() == reference.keys()
+            for k in reference:
+                assert torch.equal(sample[k], reference[k])
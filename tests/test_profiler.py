@@ -0,0 +1,84 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+
+import pytest
+import torch
+
+from bidastereo.benchmarks.utils import build_model, synthetic_video
+from bidastereo.models.core.utils.profiler import (
+    PeakMemory,
+    StageProfiler,
+    read_peak_rss,
+    read_rss,
+    reset_peak_rss,
+)
+
+SIZE = 2 ** 28
+
+# the memory tests start from a reset peak RSS, which needs /proc/self/clear_refs
+needs_peak_reset = pytest.mark.skipif(
+    not os.access("/proc/self/clear_refs", os.W_OK), reason="peak RSS is not resettable"
+)
+
+
+def allocate():
+    data = torch.ones(SIZE // 4)
+    del data
+
+
+@needs_peak_reset
+def test_regions_keep_the_peak_of_the_process():
+    profiler = StageProfiler("cpu")
+    reset_peak_rss()
+    start = read_rss()
+    allocate()
+    with profiler.region("outer"):
+        with profiler.region("inner"):
+            pass
+    assert read_peak_rss() - start >= 0.9 * SIZE
+
+
+@needs_peak_reset
+def test_peak_of_nested_regions():
+    profiler = StageProfiler("cpu")
+    reset_peak_rss()
+    start = read_rss()
+    with profiler.region("outer"):
+        with profiler.region("inner"):
+            allocate()
+        with profiler.region("after"):
+            pass
+    summary = profiler.summary()
+    assert summary["inner"]["peak_memory_mb"] * 2 ** 20 - start >= 0.9 * SIZE
+    assert summary["outer"]["peak_memory_mb"] * 2 ** 20 - start >= 0.9 * SIZE
+    assert summary["after"]["peak_memory_mb"] * 2 ** 20 - start < 0.5 * SIZE
+
+
+@needs_peak_reset
+def test_peak_memory_of_a_block():
+    device = torch.device("cpu")
+    profiler = StageProfiler("cpu")
+    reset_peak_rss()
+    with PeakMemory(device) as memory:
+        with profiler.region("region"):
+            allocate()
+        with profiler.region("after"):
+            pass
+    assert memory.peak >= 0.9 * SIZE
+
+
+def test_feature_warp_covers_the_motion_hidden_states():
+    model = build_model("cpu")
+    model.profiler = StageProfiler("cpu")
+    with torch.no_grad():
+        model.forward_batch_test(
+            {"stereo_video": synthetic_video(4, 128, 128)}, kernel_size=4, iters=2
+        )
+    calls = {name: stats["calls"] for name, stats in model.profiler.summary().items()}
+    # two feature warps after fnet, two hidden state warps in each update
+    assert calls["feature_warp"] == 2 * calls["fnet"] + 2 * calls["update_block"]
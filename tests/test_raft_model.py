@@ -0,0 +1,22 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from bidastereo.models.raft_model import RAFTModel
+
+
+@pytest.mark.parametrize("downscale", [1, 2, 4])
+def test_flow_of_small_inputs(downscale):
+    torch.manual_seed(0)
+    raft = RAFTModel(device="cpu", iters=2, downscale=downscale, model_weights="").eval()
+    image1 = 255 * torch.rand(2, 3, 64, 96)
+    image2 = torch.roll(image1, 2, dims=-1)
+    with torch.no_grad():
+        flow = raft(image1, image2)
+    assert flow.shape == (2, 2, 16, 24)
+    assert torch.isfinite(flow).all()
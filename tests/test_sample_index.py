@@ -0,0 +1,54 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+
+from bidastereo.datasets.sample_index import SequenceWindows
+from bidastereo.datasets.shards import frame_slice
+
+
+def sequence_files(name, num_frames):
+    files = {"image": {}, "metadata": {}, "viewpoint": {}}
+    for cam in ("left", "right"):
+        files["image"][cam] = [f"{name}/{cam}/{t:04d}.png" for t in range(num_frames)]
+        files["metadata"][cam] = [[name, (t, cam)] for t in range(num_frames)]
+        viewpoints = np.zeros(num_frames, dtype=[("T", np.float64, (3,))])
+        viewpoints["T"][:, 0] = np.arange(num_frames)
+        files["viewpoint"][cam] = viewpoints
+    return files
+
+
+def test_windows_match_slices_of_the_files():
+    windows = SequenceWindows(skip_keys=("metadata",))
+    sequences = [sequence_files("a", 10), sequence_files("b", 7)]
+    expected = []
+    for name, files in zip("ab", sequences):
+        sequence_id = windows.add_sequence(name, files)
+        for start, step, length in ((0, 1, 3), (2, 2, 4), (6, -1, 3), (6, -3, 3)):
+            windows.append(sequence_id, start, step, length)
+            expected.append((files, frame_slice(start, step, length)))
+    windows.freeze()
+
+    # every frame of the metadata is pickled on its own
+    assert len(windows.objects) == 2 * (10 + 7)
+    assert len(windows) == len(expected)
+    for sample, (files, frames) in zip(windows, expected):
+        assert "metadata" not in sample
+        for cam in ("left", "right"):
+            assert sample["image"][cam] == files["image"][cam][frames]
+            np.testing.assert_array_equal(
+                sample["viewpoint"][cam], files["viewpoint"][cam][frames]
+            )
+
+    repeated = 2 * windows
+    assert len(repeated) == 2 * len(windows)
+    assert repeated[len(windows)]["image"] == windows[0]["image"]
+    all_files = SequenceWindows()
+    all_files.add_sequence("a", sequences[0])
+    all_files.freeze()
+    name, files = next(all_files.sequence_items())
+    assert name == "a"
+    assert files["metadata"]["right"] == sequences[0]["metadata"]["right"]
@@ -0,0 +1,73 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from bidastereo.benchmarks.utils import build_model, synthetic_video
+from bidastereo.models.core.bidastereo import BiDAStereo
+
+
+@pytest.mark.parametrize("mode", ["linear", "cosine"])
+@pytest.mark.parametrize("overlap", [1, 2, 3])
+def test_blend_weights_of_neighbouring_windows_sum_to_one(mode, overlap):
+    first = BiDAStereo.blend_weights(6, 0, overlap, mode)
+    second = BiDAStereo.blend_weights(6, overlap, 0, mode)
+    assert torch.equal(first[: 6 - overlap], torch.ones(6 - overlap))
+    torch.testing.assert_close(first[6 - overlap :] + second[:overlap], torch.ones(overlap))
+
+
+@pytest.mark.parametrize("mode", ["linear", "cosine"])
+@pytest.mark.parametrize("stride", [1, 2, 3, 4])
+def test_blending_windows_that_agree(mode, stride):
+    model = build_model("cpu")
+    video = synthetic_video(11, 8, 8)
+
+    def run_windows(video, starts, kernel_size, **kwargs):
+        # every window predicts minus the frame index as the disparity
+        for start in starts:
+            frames = torch.arange(start, start + kernel_size, dtype=torch.float)
+            yield start, -frames[:, None, None, None, None].expand(-1, 1, 1, 8, 8)
+
+    model.run_windows = run_windows
+    disparity = torch.zeros(11, 1, 8, 8)
+    model.blend_windows(video, disparity, 4, stride, mode)
+    expected = torch.arange(11, dtype=torch.float)[:, None, None, None].expand_as(disparity)
+    torch.testing.assert_close(disparity, expected)
+
+
+def concatenated_windows(model, video, kernel_size, iters):
+    """Trim stitching as it was done before the output was preallocated."""
+    stride = kernel_size // 2
+    num_ims = len(video)
+    if (num_ims - kernel_size) % stride == 1:
+        video = torch.cat([video, video[-1:]])
+    disp_preds = []
+    for start in range(0, len(video), stride):
+        window = video[start : start + kernel_size]
+        disparities = model.forward_window(window[:, 0], window[:, 1], iters=iters)
+        disparities = model.trim_window(
+            disparities, kernel_size, stride, first=len(disp_preds) == 0
+        )
+        if disparities is not None:
+            disp_preds.append(disparities)
+    return torch.cat(disp_preds).squeeze(1).abs()[:num_ims, :1]
+
+
+@pytest.mark.parametrize("num_frames", [8, 9])
+def test_preallocated_output_matches_concatenated_windows(num_frames, tmp_path):
+    model = build_model("cpu")
+    video = synthetic_video(num_frames, 64, 96)
+    with torch.no_grad():
+        expected = concatenated_windows(model, video, 4, iters=2)
+        for output_dir in ("", str(tmp_path)):
+            predictions = model.forward_batch_test(
+                {"stereo_video": video}, kernel_size=4, iters=2, output_dir=output_dir
+            )
+            # the flows shared between windows are computed in other batches
+            torch.testing.assert_close(
+                predictions["disparity"], expected, rtol=0, atol=1e-5
+            )
@@ -0,0 +1,35 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from bidastereo.benchmarks.utils import build_model, synthetic_video
+from bidastereo.models.core.bidastereo import BiDAStereoStream
+
+
+def test_stream_matches_forward_batch_test():
+    model = build_model("cpu")
+    video = synthetic_video(7, 128, 128)
+    with torch.no_grad():
+        expected = model.forward_batch_test({"stereo_video": video}, kernel_size=4, iters=2)
+
+    stream = BiDAStereoStream(model, kernel_size=4, iters=2)
+    outputs = [stream.push(left, right) for left, right in video]
+    outputs.append(stream.flush())
+    disparities = torch.cat(outputs)
+    assert torch.equal(disparities, expected["disparity"])
+
+
+def test_flush_without_pending_frames():
+    model = build_model("cpu")
+    stream = BiDAStereoStream(model, kernel_size=4, iters=2)
+    assert stream.flush().shape == (0, 1, 0, 0)
+
+    video = synthetic_video(2, 128, 128)
+    for left, right in video:
+        assert stream.push(left, right).shape == (0, 1, 128, 128)
+    assert stream.flush().shape == (2, 1, 128, 128)
+    assert stream.flush().shape == (0, 1, 128, 128)
@@ -0,0 +1,41 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from bidastereo.models.core.utils.utils import flow_warp
+
+
+def reference_flow_warp(x, flow, interpolation="bilinear", padding_mode="zeros"):
+    """The per-module warp of BiDAStereo and MultiMotionEncoder that flow_warp replaced."""
+    flow = flow.permute(0, 2, 3, 1)
+    _, _, h, w = x.size()
+    grid_y, grid_x = torch.meshgrid(
+        torch.arange(0, h), torch.arange(0, w), indexing="ij"
+    )
+    grid = torch.stack((grid_x, grid_y), 2).type_as(x)
+    grid_flow = grid + flow
+    grid_flow_x = 2.0 * grid_flow[:, :, :, 0] / max(w - 1, 1) - 1.0
+    grid_flow_y = 2.0 * grid_flow[:, :, :, 1] / max(h - 1, 1) - 1.0
+    grid_flow = torch.stack((grid_flow_x, grid_flow_y), dim=3)
+    return F.grid_sample(
+        x, grid_flow, mode=interpolation, padding_mode=padding_mode, align_corners=True
+    )
+
+
+@pytest.mark.parametrize("size", [(6, 10), (1, 7), (9, 1)])
+@pytest.mark.parametrize("padding_mode", ["zeros", "border"])
+def test_flow_warp_matches_reference(size, padding_mode):
+    g = torch.Generator().manual_seed(0)
+    x = torch.randn(3, 4, *size, generator=g)
+    flow = 4 * torch.randn(3, 2, *size, generator=g)
+
+    expected = reference_flow_warp(x, flow, padding_mode=padding_mode)
+    for layout in (flow, flow.permute(0, 2, 3, 1)):
+        warped = flow_warp(x, layout, padding_mode=padding_mode)
+        torch.testing.assert_close(warped, expected, rtol=1e-5, atol=1e-5)
@@ -24,6 +24,7 @@ from bidastereo.train_utils.utils import (
 )
 from bidastereo.train_utils.logger import Logger
 from bidastereo.models.core.bidastereo import BiDAStereo
+from bidastereo.models.core.utils.profiler import StageProfiler
 
 from bidastereo.evaluation.core.evaluator import Evaluator
 from bidastereo.train_utils.losses import sequence_loss
@@ -52,11 +53,15 @@ def fetch_optimizer(args, model):
 
 def forward_batch(batch, model, args):
     output = {}
+    flows = None
+    if "flow" in batch:
+        flows = (batch["flow"][:, :, 0], batch["flow"][:, :, 1])
     disparities = model(
         batch["img"][:, :, 0],
         batch["img"][:, :, 1],
         iters=args.train_iters,
         test_mode=False,
+        flows=flows,
     )
     num_traj = len(batch["disp"][0])
 
@@ -104,6 +109,10 @@ class Lite(LightningLite):
         else:
             raise ValueError("Wrong Model!")
 
+        # stage profile of the forward pass
+        profiler = StageProfiler() if args.profile else None
+        model.profiler = profiler
+
         with open(args.ckpt_path + "/meta.json", "w") as file:
             json.dump(vars(args), file, sort_keys=True, indent=4)
 
@@ -205,6 +214,8 @@ class Lite(LightningLite):
                     logger.writer.add_scalar(
                         f"learning_rate", optimizer.param_groups[0]["lr"], total_steps
                     )
+                    if profiler is not None and total_steps % Logger.SUM_FREQ == 0:
+                        logger.write_dict(profiler.scalars())
                     global_batch_num += 1
                 self.barrier()
                 self.backward(scaler.scale(loss))
@@ -246,6 +257,8 @@ class Lite(LightningLite):
                     should_keep_training = False
                     break
 
+        if profiler is not None and self.global_rank == 0:
+            profiler.dump(f"{args.ckpt_path}/profile_train.json")
         logger.close()
         PATH = f"{args.ckpt_path}/{args.name}_final.pth"
         torch.save(model.module.module.state_dict(), PATH)
@@ -331,6 +344,34 @@ if __name__ == "__main__":
     parser.add_argument(
         "--num_workers", type=int, default=6, help="number of dataloader workers."
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record the time and peak memory of the model stages.",
+    )
+    parser.add_argument(
+        "--flow_root",
+        default=None,
+        help="load the RAFT flows precomputed by scripts/precompute_flows.py from this directory.",
+    )
+    parser.add_argument(
+        "--data_backend",
+        default="files",
+        choices=["files", "shard"],
+        help="decode the training frames from the image files or read them from shards.",
+    )
+    parser.add_argument(
+        "--shard_root",
+        default=None,
+        help="directory of the shards written by scripts/convert_to_shards.py.",
+    )
+    parser.add_argument(
+        "--decode_threads",
+        type=int,
+        default=0,
+        help="threads decoding the frames of a sample in each dataloader worker, "
+        "-1 splits the CPU cores between the workers.",
+    )
     # Validation parameters
     parser.add_argument(
         "--valid_iters",